@@ -0,0 +1,250 @@
+'''
+    bench_bcrypt
+    ------------
+
+    Benchmarks of Flask-Bcrypt's hashing throughput and latency.
+
+    Measures ops/sec and p50/p95/p99 latency of `generate_password_hash` and
+    `check_password_hash` across log rounds, prefixes, long password handling,
+    executors and concurrency levels, as well as of a verification done in a
+    view through the Flask test client and the time it takes a fresh
+    interpreter to import the extension. Results are written as JSON and can be
+    compared against those of another version to catch regressions::
+
+        $ python bench_bcrypt.py --rounds 4 8 --output new.json
+        $ python bench_bcrypt.py --rounds 4 8 --compare old.json
+
+    :copyright: (c) 2011 by Max Countryman.
+    :license: BSD, see LICENSE for more details.
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+import flask
+
+import flask_bcrypt
+
+PASSWORD = 'correct horse battery staple'
+
+
+def percentile(values, fraction):
+    '''Returns the nearest-rank percentile of sorted `values`.'''
+    index = max(0, int(round(fraction * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, elapsed):
+    '''Returns throughput and latency percentiles, in milliseconds, of a run
+    of `latencies` seconds that took `elapsed` seconds overall.'''
+    latencies = sorted(latencies)
+    return {
+        'n': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run(func, iterations, concurrency):
+    '''Calls `func` `iterations` times from `concurrency` threads and
+    returns the summary of the latencies.'''
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(_):
+        start = time.perf_counter()
+        func()
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for i in range(iterations):
+            timed(i)
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(timed, range(iterations)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def make_app(rounds, prefix, long_passwords, executor, concurrency):
+    app = flask.Flask(__name__)
+    app.config['BCRYPT_LOG_ROUNDS'] = rounds
+    app.config['BCRYPT_HASH_PREFIX'] = prefix
+    app.config['BCRYPT_HANDLE_LONG_PASSWORDS'] = long_passwords
+    if executor != 'inline':
+        app.config['BCRYPT_EXECUTOR'] = executor
+        app.config['BCRYPT_MAX_WORKERS'] = concurrency
+    return app
+
+
+def bench_hashing(options):
+    '''Benchmarks the extension's methods over every combination of the
+    selected parameters.'''
+    matrix = itertools.product(options.rounds, options.prefixes,
+                               options.long_passwords, options.executors,
+                               options.concurrency)
+    for rounds, prefix, long_passwords, executor, concurrency in matrix:
+        app = make_app(rounds, prefix, long_passwords, executor, concurrency)
+        bcrypt_ = flask_bcrypt.Bcrypt(app)
+        pw_hash = bcrypt_.generate_password_hash(PASSWORD)
+        operations = {
+            'generate': lambda: bcrypt_.generate_password_hash(PASSWORD),
+            'check': lambda: bcrypt_.check_password_hash(pw_hash, PASSWORD),
+        }
+        try:
+            for operation, func in sorted(operations.items()):
+                result = {
+                    'benchmark': operation, 'rounds': rounds,
+                    'prefix': prefix, 'long_passwords': long_passwords,
+                    'executor': executor, 'concurrency': concurrency,
+                }
+                result.update(run(func, options.iterations, concurrency))
+                yield result
+        finally:
+            bcrypt_.shutdown_executor()
+
+
+def bench_request(options):
+    '''Benchmarks a login view verifying a password through the Flask test
+    client.'''
+    for rounds in options.rounds:
+        app = make_app(rounds, '2b', False, 'inline', 1)
+        bcrypt_ = flask_bcrypt.Bcrypt(app)
+        pw_hash = bcrypt_.generate_password_hash(PASSWORD)
+
+        @app.route('/login', methods=['POST'])
+        def login():
+            if bcrypt_.check_password_hash(pw_hash, flask.request.data):
+                return 'ok'
+            return 'denied', 401
+
+        client = app.test_client()
+        result = {
+            'benchmark': 'request', 'rounds': rounds, 'prefix': '2b',
+            'long_passwords': False, 'executor': 'inline', 'concurrency': 1,
+        }
+        result.update(run(lambda: client.post('/login', data=PASSWORD),
+                          options.iterations, 1))
+        yield result
+
+
+def bench_import(options):
+    '''Benchmarks importing the extension in a fresh interpreter that has
+    already imported Flask.'''
+    code = ('import time, flask; start = time.perf_counter(); '
+            'import flask_bcrypt; print(time.perf_counter() - start)')
+    # Import the module next to this checkout rather than an installed one.
+    cwd = os.path.dirname(os.path.abspath(flask_bcrypt.__file__))
+    latencies = [float(subprocess.check_output([sys.executable, '-c', code],
+                                               cwd=cwd))
+                 for _ in range(options.import_iterations)]
+    result = {
+        'benchmark': 'import', 'rounds': None, 'prefix': None,
+        'long_passwords': None, 'executor': None, 'concurrency': 1,
+    }
+    result.update(summarize(latencies, sum(latencies)))
+    yield result
+
+
+def result_key(result):
+    return tuple(result[k] for k in ('benchmark', 'rounds', 'prefix',
+                                     'long_passwords', 'executor',
+                                     'concurrency'))
+
+
+def compare(results, baseline, threshold):
+    '''Prints the change in throughput against `baseline` and returns the
+    results whose throughput dropped by more than `threshold`.'''
+    previous = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        change = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(result)
+            flag = '  REGRESSION'
+        print('{0:<60} {1:+7.1%}{2}'.format(
+            ' '.join(str(k) for k in result_key(result)), change, flag))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark Flask-Bcrypt hashing throughput and latency.')
+    parser.add_argument('--rounds', type=int, nargs='+', default=[4, 8, 10])
+    parser.add_argument('--prefixes', nargs='+', default=['2b'],
+                        choices=['2a', '2b'])
+    parser.add_argument('--long-passwords', nargs='+', default=[False, True],
+                        type=lambda v: v.lower() in ('1', 'true', 'on'),
+                        help='long password handling settings, e.g. off on')
+    parser.add_argument('--executors', nargs='+', default=['inline'],
+                        choices=['inline', 'thread', 'process'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--no-request', action='store_true',
+                        help='skip the Flask test client benchmark')
+    parser.add_argument('--import-iterations', type=int, default=20,
+                        help='fresh interpreters timed importing the '
+                             'extension, 0 to skip')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare against results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='throughput drop reported as a regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = []
+    benchmarks = [bench_hashing]
+    if not options.no_request:
+        benchmarks.append(bench_request)
+    if options.import_iterations:
+        benchmarks.append(bench_import)
+    for benchmark in benchmarks:
+        for result in benchmark(options):
+            print('{0:<60} {1:9.1f} ops/s  p50 {2:8.2f} ms  p95 {3:8.2f} ms  '
+                  'p99 {4:8.2f} ms'.format(
+                      ' '.join(str(k) for k in result_key(result)),
+                      result['ops_per_sec'], result['p50_ms'],
+                      result['p95_ms'], result['p99_ms']))
+            results.append(result)
+
+    report = {
+        'flask_bcrypt': flask_bcrypt.__version__,
+        'bcrypt': getattr(bcrypt, '__version__', None),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,18 +16,458 @@ __version__ = '.'.join(__version_info__)
 __author__ = 'Max Countryman'
 __license__ = 'BSD'
 __copyright__ = '(c) 2011 by Max Countryman'
-__all__ = ['Bcrypt', 'check_password_hash', 'generate_password_hash']
+__all__ = ['Bcrypt', 'check_password_hash', 'generate_password_hash',
+           'async_check_password_hash', 'async_generate_password_hash',
+           'Calibration', 'VerificationCache', 'CacheBackend',
+           'MemoryCacheBackend', 'FileCacheBackend', 'KeyValueCacheBackend',
+           'HashingLimiter', 'HashingSaturatedError', 'HashingMetrics',
+           'hash_started', 'hash_finished', 'PasswordHash', 'scan_hashes',
+           'LegacyHashMigration', 'HashingBudget',
+           'HashingBudgetExceededError', 'RateLimiter', 'RateLimitBackend',
+           'MemoryRateLimitBackend', 'KeyValueRateLimitBackend',
+           'RateLimitExceededError', 'register_prehash', 'KDFBackend',
+           'PBKDF2Backend', 'Argon2Backend', 'register_backend', 'SaltPool',
+           'HashingSpan']
 
+import atexit
+import base64
+import bisect
+import contextlib
+import functools
 import hmac
+import itertools
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict, deque, namedtuple
 
-try:
-    import bcrypt
-except ImportError as e:
-    print('bcrypt is required to use Flask-Bcrypt')
-    raise e
+import click
+from flask import (current_app, g, has_app_context, has_request_context,
+                   request)
+from flask.cli import AppGroup
+from flask.signals import Namespace
+from werkzeug.security import \
+    check_password_hash as _werkzeug_check_password_hash
 
 import hashlib
 
+# bcrypt, asyncio and concurrent.futures are only imported once they are
+# needed, which keeps importing the extension cheap for CLI commands and cold
+# starts that never hash a password.
+_bcrypt_module = None
+
+_EXECUTOR_TYPES = {
+    'thread': 'ThreadPoolExecutor',
+    'process': 'ProcessPoolExecutor',
+}
+
+_signals = Namespace()
+
+#: Sent by a :class:`Bcrypt` instance before it computes a hash, with the
+#: `operation` (``'generate'`` or ``'check'``), `cost` and `prefix`.
+hash_started = _signals.signal('bcrypt-hash-started')
+
+#: Sent by a :class:`Bcrypt` instance after it computed a hash, with the same
+#: arguments as :data:`hash_started` plus the `duration` of the hash and the
+#: `wait` for admission by the limiter, both in seconds.
+hash_finished = _signals.signal('bcrypt-hash-finished')
+
+#: The outcome of :meth:`Bcrypt.calibrate`: the chosen cost and the measured
+#: duration of a single hash at that cost, in milliseconds.
+Calibration = namedtuple('Calibration', ['log_rounds', 'measured_ms'])
+
+#: A hash recorded while profiling, see :meth:`Bcrypt.get_request_spans`:
+#: the `operation`, `prefix` and `cost`, the `executor` it ran on
+#: (``'inline'``, ``'thread'``, ``'process'``, ``'loop'`` for the event
+#: loop's default executor, or the class name of a custom executor), its
+#: `start` as a :func:`time.time` timestamp, and the `wait` for admission by
+#: the limiter and the `duration` of the hash itself, both in seconds.
+HashingSpan = namedtuple('HashingSpan', ['operation', 'prefix', 'cost',
+                                         'executor', 'start', 'wait',
+                                         'duration'])
+
+# The hashing settings of an app or blueprint, resolved once by `init_app`.
+_Settings = namedtuple('_Settings', ['log_rounds', 'prefix', 'prefix_bytes',
+                                     'handle_long_passwords', 'prehash',
+                                     'pepper', 'backend'])
+
+_DEFAULT_SETTINGS = _Settings(12, '2b', b'2b', False, None, None, None)
+
+
+class _AppState(object):
+    '''What `init_app` sets up for an app, stored in
+    `app.extensions['bcrypt']`: its settings, the settings of its blueprints
+    that override some of them, by name, and the cache, limiters, salt pool
+    and executor built from its config. Only the :class:`Bcrypt` instances
+    in `owners`, initialized with the app, use them.'''
+
+    def __init__(self, settings=_DEFAULT_SETTINGS, blueprints=None):
+        self.settings = settings
+        self.blueprints = blueprints or {}
+        self.owners = weakref.WeakSet()
+        self.calibration = None
+        self.verification_cache = None
+        self.limiter = None
+        self.rate_limiter = None
+        self.request_max_operations = None
+        self.request_timeout = None
+        self.request_timeout_header = None
+        self.profile = False
+        self.tracer = None
+        self.salt_pool = None
+        self.executor_type = None
+        self.max_workers = None
+        self.managed_executor = None
+        self.executor_lock = threading.Lock()
+
+    def shutdown_executor(self, wait=True):
+        '''Shuts down the managed executor, if it has been started.'''
+        with self.executor_lock:
+            executor, self.managed_executor = self.managed_executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def reset_executor(self):
+        '''Discards the managed executor and the pregenerated salts, see
+        :meth:`Bcrypt._reset_executor`.'''
+        self.managed_executor = None
+        self.executor_lock = threading.Lock()
+        if self.salt_pool is not None:
+            self.salt_pool.clear()
+
+
+def _load_settings(config, defaults):
+    '''Returns the :class:`_Settings` described by the `BCRYPT_*` keys of
+    `config`, falling back to `defaults` for missing keys.'''
+    prefix = config.get('BCRYPT_HASH_PREFIX', defaults.prefix)
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode('ascii')
+    prehash = config.get('BCRYPT_PREHASH', defaults.prehash)
+    if prehash is not None and prehash not in _PREHASH_STRATEGIES:
+        raise ValueError(
+            'BCRYPT_PREHASH must be one of {0}, not {1!r}.'.format(
+                ', '.join(sorted(_PREHASH_STRATEGIES)), prehash))
+    pepper = config.get('BCRYPT_PEPPER', defaults.pepper)
+    if isinstance(pepper, str):
+        pepper = pepper.encode('utf-8')
+    backend = config.get('BCRYPT_BACKEND', defaults.backend)
+    if backend == 'bcrypt':
+        backend = None
+    elif backend == 'pbkdf2':
+        backend = PBKDF2Backend()
+    elif backend == 'argon2id':
+        backend = Argon2Backend()
+    elif backend is not None and not isinstance(backend, KDFBackend):
+        raise ValueError(
+            'BCRYPT_BACKEND must be bcrypt, pbkdf2, argon2id or a '
+            'KDFBackend, not {0!r}.'.format(backend))
+    if backend is not None:
+        for ident in backend.idents:
+            if ident not in _KDF_BACKENDS:
+                raise ValueError(
+                    'No backend verifies {0!r} hashes, register one with '
+                    'register_backend().'.format(ident))
+    return _Settings(
+        config.get('BCRYPT_LOG_ROUNDS', defaults.log_rounds), prefix,
+        prefix.encode('ascii'),
+        config.get('BCRYPT_HANDLE_LONG_PASSWORDS',
+                   defaults.handle_long_passwords),
+        prehash, pepper, backend)
+
+
+class HashingSaturatedError(RuntimeError):
+    '''Raised instead of hashing when the :class:`HashingLimiter` has no
+    capacity left, so that callers can fail fast, for example with an HTTP
+    429 or 503 response.'''
+
+
+class HashingBudgetExceededError(HashingSaturatedError):
+    '''Raised instead of hashing when the current request's
+    :class:`HashingBudget` has no operations left or its deadline cannot
+    accommodate another hash.'''
+
+
+class RateLimitExceededError(RuntimeError):
+    '''Raised instead of verifying a password when the :class:`RateLimiter`
+    has no attempts left for the caller's identity, for example to be
+    answered with an HTTP 429 response. `retry_after` holds the number of
+    seconds until the next attempt is allowed.'''
+
+    def __init__(self, message, retry_after):
+        super(RateLimitExceededError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# Every Bcrypt instance that may own an executor, so that executors can be
+# shut down at interpreter exit and discarded in forked children.
+_instances = weakref.WeakSet()
+
+# The prefixes of hashes made by bcrypt rather than another KDFBackend.
+_BCRYPT_PREFIXES = ('2a', '2b', '2y')
+
+
+def _bcrypt_settings(pw_hash):
+    '''Returns the prefix and cost of a bcrypt salt or hash as a tuple, or
+    those reported by the :class:`KDFBackend` of another hash, or
+    `(None, None)` if it cannot be parsed.
+
+    :param pw_hash: The salt or hash as bytes, or a :class:`PasswordHash`.'''
+    if isinstance(pw_hash, PasswordHash):
+        return pw_hash.prefix, pw_hash.cost
+    if pw_hash.startswith(_WERKZEUG_PREFIXES):
+        # e.g. b'pbkdf2:sha256:600000$' is reported as pbkdf2:sha256 with a
+        # cost of 600000, and b'scrypt:32768:8:1$' as scrypt with 32768.
+        method = pw_hash.split(b'$', 1)[0].decode('ascii', 'replace')
+        args = method.split(':')
+        costs = [int(arg) for arg in args[1:] if arg.isdigit()]
+        name = ':'.join(arg for arg in args if not arg.isdigit())
+        return name, costs[0] if costs else None
+    if pw_hash.startswith(_WRAPPED_PREFIX):
+        method, _, tail = pw_hash[len(_WRAPPED_PREFIX):].partition(b'$')
+        name, _ = _bcrypt_settings(method + b'$')
+        prefix, cost = _bcrypt_settings(b'$' + tail.partition(b'$')[2])
+        if prefix is None:
+            return None, None
+        return '{0}+{1}'.format(name, prefix), cost
+    backend = _kdf_backend(pw_hash)
+    if backend is not None:
+        return backend.settings(pw_hash)
+    # A bcrypt hash looks like b'$2b$12$' followed by salt and digest.
+    parts = pw_hash.split(b'$')
+    if len(parts) != 4 or parts[0] or not parts[2].isdigit():
+        return None, None
+    return parts[1].decode('ascii', 'replace'), int(parts[2])
+
+
+def _kdf_backend(pw_hash):
+    '''Returns the registered :class:`KDFBackend` identified by the first
+    field of `pw_hash`, or None for bcrypt and unknown hashes.
+
+    :param pw_hash: The salt or hash as bytes.'''
+    if pw_hash[:1] != b'$':
+        return None
+    ident = pw_hash[1:].partition(b'$')[0].decode('ascii', 'replace')
+    return _KDF_BACKENDS.get(ident)
+
+
+# Hashes made by werkzeug.security.generate_password_hash, which may be
+# verified but are never generated.
+_WERKZEUG_PREFIXES = (b'pbkdf2:', b'scrypt:')
+
+# Marks a werkzeug hash wrapped in bcrypt: b'$fbw$' + method + b'$' + salt
+# followed by the bcrypt hash of the werkzeug digest.
+_WRAPPED_PREFIX = b'$fbw$'
+
+
+def _werkzeug_digest(method, salt, password):
+    '''Recomputes the hex digest of a werkzeug hash from its method and
+    salt, as `werkzeug.security` does.
+
+    :param method: The method, e.g. `'pbkdf2:sha256:600000'`.
+    :param salt: The salt as a unicode string.
+    :param password: The password as bytes.'''
+    name, _, args = method.partition(':')
+    args = args.split(':')
+    salt = salt.encode('utf-8')
+    if name == 'pbkdf2' and len(args) == 2:
+        return hashlib.pbkdf2_hmac(args[0], password, salt,
+                                   int(args[1])).hex()
+    if name == 'scrypt' and len(args) == 3:
+        n, r, p = (int(arg) for arg in args)
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=132 * n * r * p).hex()
+    raise ValueError('Unsupported werkzeug hash method {0!r}.'.format(method))
+
+
+def _wrapped_password(digest):
+    '''Returns the bcrypt input for a werkzeug hex `digest`. Digests beyond
+    bcrypt's 72 byte limit are shortened to a sha256 hexdigest.'''
+    digest = digest.encode('ascii')
+    if len(digest) > 72:
+        digest = hashlib.sha256(digest).hexdigest().encode('ascii')
+    return digest
+
+
+# Marks a hash of a pre-hashed password: b'$fbp$' + strategy followed by the
+# bcrypt hash of the pre-hashed password.
+_PREHASHED_PREFIX = b'$fbp$'
+
+
+def _digest_prehash(digestmod, encoding, keyed=False):
+    '''Returns a pre-hash strategy encoding the `digestmod` digest of the
+    password, an HMAC keyed with the pepper if `keyed`, as `'hex'` or
+    `'b64'`.'''
+    def prehash(password, pepper):
+        if keyed:
+            if not pepper:
+                raise ValueError(
+                    'BCRYPT_PEPPER is required for HMAC pre-hashing.')
+            digest = hmac.new(pepper, password, digestmod).digest()
+        else:
+            digest = getattr(hashlib, digestmod)(password).digest()
+        if encoding == 'hex':
+            return digest.hex().encode('ascii')
+        return base64.b64encode(digest)
+    return prehash
+
+
+# Pre-hash strategies by name. Each maps a password and the pepper, if any,
+# to at most 72 bytes without NUL bytes, at which bcrypt would truncate. The
+# digest of SHA-512 exceeds 72 bytes in either encoding, so SHA-384, its
+# truncated variant, is offered instead.
+_PREHASH_STRATEGIES = {
+    'sha256-hex': _digest_prehash('sha256', 'hex'),
+    'sha256-b64': _digest_prehash('sha256', 'b64'),
+    'sha384-b64': _digest_prehash('sha384', 'b64'),
+    'hmac-sha256-b64': _digest_prehash('sha256', 'b64', keyed=True),
+}
+
+
+def register_prehash(name, func):
+    '''Registers a pre-hash strategy under `name`, making it available to
+    `BCRYPT_PREHASH` and to the verification of hashes made with it::
+
+        def blake2b_prehash(password, pepper):
+            digest = hashlib.blake2b(password, key=pepper or b'').digest()
+            return base64.b64encode(digest)
+
+        register_prehash('blake2b-b64', blake2b_prehash)
+
+    Since the name is stored in every hash made with the strategy, the
+    strategy must stay registered, and unchanged, as long as such hashes
+    exist.
+
+    :param name: The name of the strategy, without `$`.
+    :param func: Callable mapping the password and the pepper, both bytes or
+                 None for a missing pepper, to at most 72 bytes without NUL
+                 bytes.
+    '''
+    if not name or '$' in name or not name.isascii():
+        raise ValueError('Invalid pre-hash strategy name {0!r}.'.format(name))
+    _PREHASH_STRATEGIES[name] = func
+
+
+def _split_prehash(pw_hash):
+    '''Returns the pre-hash strategy of `pw_hash`, or None, and the bcrypt
+    hash within it.
+
+    :param pw_hash: The hash as bytes.'''
+    if not pw_hash.startswith(_PREHASHED_PREFIX):
+        return None, pw_hash
+    name, _, tail = pw_hash[len(_PREHASHED_PREFIX):].partition(b'$')
+    return name.decode('ascii', 'replace'), b'$' + tail
+
+
+def _bcrypt():
+    '''Returns the bcrypt module, importing it on first use.'''
+    global _bcrypt_module
+    if _bcrypt_module is None:
+        try:
+            import bcrypt
+        except ImportError as e:
+            print('bcrypt is required to use Flask-Bcrypt')
+            raise e
+        _bcrypt_module = bcrypt
+    return _bcrypt_module
+
+
+def __getattr__(name):
+    # Keeps `flask_bcrypt.bcrypt` working now that bcrypt is imported lazily.
+    if name == 'bcrypt':
+        return _bcrypt()
+    raise AttributeError(
+        'module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+def _hashpw(password, salt):
+    '''Module level wrapper around `bcrypt.hashpw`, or the `hashpw` method
+    of the :class:`KDFBackend` of `salt`, so that it can be pickled and sent
+    to a process pool.
+
+    Werkzeug hashes are verified here too, so that they go through the same
+    executor, limiter and budget. A plain werkzeug `salt` is returned as is
+    if `password` matches it and `b''` otherwise. For a werkzeug hash wrapped
+    by :meth:`Bcrypt.wrap_legacy_hash` the werkzeug digest of `password` is
+    hashed with the bcrypt hash within, and returned with the same header.'''
+    if salt.startswith(_WERKZEUG_PREFIXES):
+        try:
+            valid = _werkzeug_check_password_hash(salt.decode('ascii'),
+                                                  password.decode('utf-8'))
+        except (UnicodeError, ValueError):
+            valid = False
+        return salt if valid else b''
+    if salt.startswith(_WRAPPED_PREFIX):
+        method, werkzeug_salt, tail = salt[len(_WRAPPED_PREFIX):].split(
+            b'$', 2)
+        digest = _werkzeug_digest(method.decode('ascii'),
+                                  werkzeug_salt.decode('ascii'), password)
+        return (_WRAPPED_PREFIX + method + b'$' + werkzeug_salt +
+                _hashpw(_wrapped_password(digest), b'$' + tail))
+    backend = _kdf_backend(salt)
+    if backend is not None:
+        return backend.hashpw(password, salt)
+    return _bcrypt().hashpw(password, salt)
+
+
+def _shutdown_executors():
+    for instance in list(_instances):
+        instance.shutdown_executor(wait=False)
+
+
+def _reset_executors_after_fork():
+    for instance in list(_instances):
+        instance._reset_executor()
+
+
+atexit.register(_shutdown_executors)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_executors_after_fork)
+
+_default_instance = None
+
+
+def _read_calibration(cache_file, key):
+    '''Returns the :data:`Calibration` stored in `cache_file` for the target
+    and prefix in `key`, or None.'''
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if all(cached.get(k) == v for k, v in key.items()):
+            return Calibration(cached['log_rounds'], cached['measured_ms'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    '''Holds an exclusive lock on `path`, shared by all processes on the
+    machine. Platforms without `fcntl` go without the lock.'''
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _default_bcrypt():
+    '''Returns the unconfigured :class:`Bcrypt` instance shared by the module
+    level helpers.'''
+    global _default_instance
+    if _default_instance is None:
+        _default_instance = Bcrypt()
+    return _default_instance
+
 
 def generate_password_hash(password, rounds=None):
     '''This helper function wraps the eponymous method of :class:`Bcrypt`. It
@@ -45,7 +485,7 @@ def generate_password_hash(password, rounds=None):
     :param password: The password to be hashed.
     :param rounds: The optional number of rounds.
     '''
-    return Bcrypt().generate_password_hash(password, rounds)
+    return _default_bcrypt().generate_password_hash(password, rounds)
 
 
 def check_password_hash(pw_hash, password):
@@ -64,7 +504,37 @@ def check_password_hash(pw_hash, password):
     :param pw_hash: The hash to be compared against.
     :param password: The password to compare.
     '''
-    return Bcrypt().check_password_hash(pw_hash, password)
+    return _default_bcrypt().check_password_hash(pw_hash, password)
+
+
+async def async_generate_password_hash(password, rounds=None):
+    '''This helper function wraps the eponymous coroutine of :class:`Bcrypt`.
+    Like :func:`generate_password_hash` it does not make use of the app
+    object, but the hashing itself is run in the event loop's default
+    executor so that the loop is free to serve other tasks meanwhile::
+
+        from flask_bcrypt import async_generate_password_hash
+        pw_hash = await async_generate_password_hash('hunter2', 10)
+
+    :param password: The password to be hashed.
+    :param rounds: The optional number of rounds.
+    '''
+    return await _default_bcrypt().async_generate_password_hash(password,
+                                                                rounds)
+
+
+async def async_check_password_hash(pw_hash, password):
+    '''This helper function wraps the eponymous coroutine of :class:`Bcrypt`.
+    Like :func:`check_password_hash` it does not make use of the app object,
+    but the hashing itself is run in the event loop's default executor::
+
+        from flask_bcrypt import async_check_password_hash
+        await async_check_password_hash(pw_hash, 'hunter2') # returns True
+
+    :param pw_hash: The hash to be compared against.
+    :param password: The password to compare.
+    '''
+    return await _default_bcrypt().async_check_password_hash(pw_hash, password)
 
 
 class Bcrypt(object):
@@ -132,14 +602,146 @@ class Bcrypt(object):
     **Warning: if this option is enabled on an existing project, disabling it
     will break password checking.**
 
+    `BCRYPT_PREHASH` is the safe alternative. It names a pre-hash strategy,
+    `'sha256-hex'`, `'sha256-b64'`, `'sha384-b64'`, `'hmac-sha256-b64'` or
+    one added with :func:`register_prehash`, which is recorded in every new
+    hash as a `$fbp$<strategy>` marker in front of the bcrypt hash. Each hash
+    is verified with its own strategy, and hashes without a marker according
+    to `BCRYPT_HANDLE_LONG_PASSWORDS`, so the strategy may be changed, or
+    enabled, on an existing project. The HMAC strategy keys the digest with
+    `BCRYPT_PEPPER`, a secret kept outside the database. `'sha256-hex'` is
+    the transformation of `BCRYPT_HANDLE_LONG_PASSWORDS`.
+
+    Rather than a fixed cost, `BCRYPT_TARGET_MS` may be set to a latency
+    budget in milliseconds. `init_app` then benchmarks bcrypt on the current
+    machine and uses the highest cost whose hash stays under the target,
+    overriding `BCRYPT_LOG_ROUNDS`. The benchmark gives up after
+    `BCRYPT_CALIBRATION_TIMEOUT` seconds (5 by default). If
+    `BCRYPT_CALIBRATION_FILE` is set, the result is stored in that file and
+    reused by other workers instead of benchmarking again. The result is
+    available as `calibration`.
+
+    `BCRYPT_BACKEND` selects the key derivation function new hashes are made
+    with: `'bcrypt'` (the default), `'pbkdf2'`, `'argon2id'` (which requires
+    `argon2-cffi`) or a :class:`KDFBackend` instance such as
+    `PBKDF2Backend(iterations=1000000)` with custom parameters. Hashes are
+    verified with the function recorded in them, so backends can be changed
+    without invalidating stored hashes. Calibration, `BCRYPT_LOG_ROUNDS` and
+    `BCRYPT_HASH_PREFIX` only apply to bcrypt.
+
+    These settings are kept per app in `app.extensions['bcrypt']`, along
+    with the verification cache, limiters, request budgets, profiling, salt
+    pool and managed executor configured below, so a single extension
+    object can serve several apps with different costs, for instance behind
+    a dispatcher. Blueprints may override them with
+    `BCRYPT_BLUEPRINTS`, a mapping from blueprint names to the keys they
+    change::
+
+        app.config['BCRYPT_BLUEPRINTS'] = {'admin': {'BCRYPT_LOG_ROUNDS': 14}}
+
+    Nested blueprints are named like `'admin.api'` and inherit the overrides
+    of their parents. The settings of the current app, as overridden by the
+    innermost listed blueprint of the current request, apply. Outside of the
+    context of an app initialized with this instance the settings of the app
+    initialized last are used, or the defaults if there is none, as for the
+    module level helpers.
+
+    Repeated verifications of the same credentials, as with HTTP Basic auth,
+    can be short-circuited by setting `BCRYPT_CACHE_ENABLED` to `True`. Only
+    successful verifications are remembered, for at most `BCRYPT_CACHE_TTL`
+    seconds (300 by default) and up to `BCRYPT_CACHE_MAX_ENTRIES` entries
+    (1024 by default), under keys derived with HMAC from
+    `BCRYPT_CACHE_KEY` (a random key by default) so that no plaintext is
+    kept. `BCRYPT_CACHE_BACKEND` selects where entries live: `'memory'`
+    (the default) for a per-process cache, `'file'` for a cache shared by
+    all workers on a host under `BCRYPT_CACHE_DIR`, or any
+    :class:`CacheBackend` instance such as a :class:`KeyValueCacheBackend`
+    wrapping a Redis client. Shared caches require every worker to use the
+    same `BCRYPT_CACHE_KEY`, which is therefore required for any backend
+    other than a :class:`MemoryCacheBackend`. See :class:`VerificationCache`.
+
+    To keep bursts of logins from pinning every core, the number of hashes
+    computed at once can be capped with `BCRYPT_MAX_CONCURRENCY`. Up to
+    `BCRYPT_MAX_QUEUE` further hashes (none by default) wait for at most
+    `BCRYPT_QUEUE_TIMEOUT` seconds (indefinitely by default) for a slot; any
+    others raise :exc:`HashingSaturatedError`. The :class:`HashingLimiter`
+    and its counters are available as `limiter`.
+
+    Hashes made by werkzeug's `generate_password_hash` (`pbkdf2:` and
+    `scrypt:`) are verified as well, as are werkzeug hashes wrapped in bcrypt
+    by :meth:`wrap_legacy_hash`, which lets a :class:`LegacyHashMigration`
+    upgrade a whole table without waiting for users to log in. Both kinds are
+    verified in the executor, under the limiter and request budget and with
+    the verification cache, like bcrypt hashes, and reported by
+    :meth:`needs_rehash`, so they are replaced with plain bcrypt hashes on
+    the next successful login.
+
+    Each request may be given a :class:`HashingBudget` of at most
+    `BCRYPT_REQUEST_MAX_OPERATIONS` hashes that must finish within
+    `BCRYPT_REQUEST_TIMEOUT` seconds of the request starting. If
+    `BCRYPT_REQUEST_TIMEOUT_HEADER` names a request header, such as one set
+    by a load balancer, a smaller number of seconds given in that header
+    takes precedence. A hash that would exceed the budget raises
+    :exc:`HashingBudgetExceededError` instead, and waiting for the limiter
+    is cut short at the deadline. Views may also set a budget with
+    :meth:`set_request_budget`.
+
+    Brute-force attempts can be turned away before any hashing by passing an
+    `identity`, such as a username or client address, to
+    :meth:`check_password_hash`. Each identity then gets a token bucket of
+    `BCRYPT_RATE_LIMIT_CAPACITY` attempts, refilled at
+    `BCRYPT_RATE_LIMIT_PER_SECOND` attempts per second, and attempts beyond
+    that raise :exc:`RateLimitExceededError`. Buckets are kept in memory for
+    up to `BCRYPT_RATE_LIMIT_MAX_KEYS` identities (10000 by default) unless
+    `BCRYPT_RATE_LIMIT_BACKEND` is a shared :class:`RateLimitBackend`. The
+    :class:`RateLimiter` is available as `rate_limiter`.
+
+    To tell how much of a slow request went into hashing, set
+    `BCRYPT_PROFILE` to `True`. Every hash is then recorded as a
+    :data:`HashingSpan` in :data:`flask.g`, available from
+    :meth:`get_request_spans`, and each response that involved hashing gets
+    a `Server-Timing` header with the time spent hashing and waiting for the
+    limiter, which browsers show in their developer tools, and a summary
+    logged at INFO level to `app.logger`. Independently, `BCRYPT_TRACER` may
+    be set to an OpenTelemetry tracer, such as
+    `opentelemetry.trace.get_tracer(__name__)`, or any object with the same
+    `start_span` method, which is then given a span for every hash.
+
+    `init_app` also registers the `flask bcrypt` command group, whose `scan`
+    command reports how many stored hashes use each prefix and cost.
+
+    Hashing can be moved off the calling thread onto an executor owned by the
+    extension, which bounds the number of cores spent on password work
+    independently of the number of request threads. Set `BCRYPT_EXECUTOR` to
+    `'thread'` or `'process'` and optionally `BCRYPT_MAX_WORKERS` to the size
+    of the pool. The pool is started on the first hash, shut down at exit and
+    discarded in children forked by a pre-forking server. Alternatively any
+    :class:`concurrent.futures.Executor` may be passed as `executor`, in which
+    case its lifecycle is left to the caller. `BCRYPT_MAX_WORKERS` should then
+    be set to the size of that executor, as batch hashing and
+    :meth:`warmup` use it to tell how many workers there are, assuming one
+    per core otherwise.
+
+    Async views may await :meth:`async_generate_password_hash` and
+    :meth:`async_check_password_hash` instead. These run bcrypt in the
+    configured executor or, if there is none, in the running event loop's
+    default executor, so the loop is not blocked while hashing::
+
+        bcrypt = Bcrypt(app, executor=ThreadPoolExecutor(4))
+        pw_hash = await bcrypt.async_generate_password_hash('hunter2')
+
     :param app: The Flask application object. Defaults to None.
+    :param executor: The executor used for hashing. Defaults to None.
     '''
 
-    _log_rounds = 12
-    _prefix = '2b'
-    _handle_long_passwords = False
-
-    def __init__(self, app=None):
+    def __init__(self, app=None, executor=None):
+        self.executor = executor
+        self.metrics = HashingMetrics()
+        self._cost_seconds = {}
+        self._dummy_hashes = {}
+        self._default_state = _AppState()
+        self._states = weakref.WeakSet([self._default_state])
+        _instances.add(self)
         if app is not None:
             self.init_app(app)
 
@@ -148,10 +750,258 @@ class Bcrypt(object):
 
         :param app: The Flask application object.
         '''
-        self._log_rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
-        self._prefix = app.config.get('BCRYPT_HASH_PREFIX', '2b')
-        self._handle_long_passwords = app.config.get(
-            'BCRYPT_HANDLE_LONG_PASSWORDS', False)
+        settings = _load_settings(app.config, _DEFAULT_SETTINGS)
+
+        calibration = None
+        target_ms = app.config.get('BCRYPT_TARGET_MS')
+        if target_ms is not None:
+            calibration = self.calibrate(
+                target_ms,
+                max_seconds=app.config.get('BCRYPT_CALIBRATION_TIMEOUT', 5),
+                cache_file=app.config.get('BCRYPT_CALIBRATION_FILE'),
+                prefix=settings.prefix)
+            settings = settings._replace(log_rounds=calibration.log_rounds)
+
+        # Nested blueprints, named like 'parent.child', inherit the settings
+        # of their closest overridden parent.
+        blueprints = {}
+        overrides = app.config.get('BCRYPT_BLUEPRINTS', {})
+        for name in sorted(overrides, key=lambda name: name.count('.')):
+            parent = name.rpartition('.')[0]
+            while parent and parent not in blueprints:
+                parent = parent.rpartition('.')[0]
+            blueprints[name] = _load_settings(
+                overrides[name], blueprints.get(parent, settings))
+        state = _AppState(settings, blueprints)
+        state.calibration = calibration
+
+        if app.config.get('BCRYPT_CACHE_ENABLED', False):
+            backend = app.config.get('BCRYPT_CACHE_BACKEND', 'memory')
+            if backend == 'memory':
+                backend = MemoryCacheBackend(
+                    app.config.get('BCRYPT_CACHE_MAX_ENTRIES', 1024))
+            elif backend == 'file':
+                backend = FileCacheBackend(
+                    app.config.get(
+                        'BCRYPT_CACHE_DIR',
+                        os.path.join(tempfile.gettempdir(), 'flask-bcrypt')),
+                    app.config.get('BCRYPT_CACHE_MAX_ENTRIES', 1024))
+            elif not isinstance(backend, CacheBackend):
+                raise ValueError(
+                    'BCRYPT_CACHE_BACKEND must be memory, file or a '
+                    'CacheBackend, not {0!r}.'.format(backend))
+            key = app.config.get('BCRYPT_CACHE_KEY')
+            if not key:
+                # A random key per worker would never hit shared entries.
+                if not isinstance(backend, MemoryCacheBackend):
+                    raise ValueError(
+                        'BCRYPT_CACHE_KEY must be set when the verification '
+                        'cache is shared by several workers.')
+                key = os.urandom(32)
+            state.verification_cache = VerificationCache(
+                key,
+                ttl=app.config.get('BCRYPT_CACHE_TTL', 300),
+                backend=backend)
+
+        max_concurrency = app.config.get('BCRYPT_MAX_CONCURRENCY')
+        if max_concurrency is not None:
+            state.limiter = HashingLimiter(
+                max_concurrency,
+                max_queue=app.config.get('BCRYPT_MAX_QUEUE', 0),
+                queue_timeout=app.config.get('BCRYPT_QUEUE_TIMEOUT'))
+
+        capacity = app.config.get('BCRYPT_RATE_LIMIT_CAPACITY')
+        if capacity is not None:
+            backend = app.config.get('BCRYPT_RATE_LIMIT_BACKEND', 'memory')
+            if backend == 'memory':
+                backend = MemoryRateLimitBackend(
+                    app.config.get('BCRYPT_RATE_LIMIT_MAX_KEYS', 10000))
+            elif not isinstance(backend, RateLimitBackend):
+                raise ValueError(
+                    'BCRYPT_RATE_LIMIT_BACKEND must be memory or a '
+                    'RateLimitBackend, not {0!r}.'.format(backend))
+            state.rate_limiter = RateLimiter(
+                capacity, app.config.get('BCRYPT_RATE_LIMIT_PER_SECOND', 1.0),
+                backend=backend)
+
+        state.request_max_operations = app.config.get(
+            'BCRYPT_REQUEST_MAX_OPERATIONS')
+        state.request_timeout = app.config.get('BCRYPT_REQUEST_TIMEOUT')
+        state.request_timeout_header = app.config.get(
+            'BCRYPT_REQUEST_TIMEOUT_HEADER')
+        if (state.request_max_operations is not None or
+                state.request_timeout is not None or
+                state.request_timeout_header is not None):
+            app.before_request(self._start_request_budget)
+
+        executor_type = app.config.get('BCRYPT_EXECUTOR')
+        if executor_type is not None and executor_type not in _EXECUTOR_TYPES:
+            raise ValueError(
+                'BCRYPT_EXECUTOR must be one of {0}, not {1!r}.'.format(
+                    ', '.join(sorted(_EXECUTOR_TYPES)), executor_type))
+        state.executor_type = executor_type
+        state.max_workers = app.config.get('BCRYPT_MAX_WORKERS')
+
+        state.profile = app.config.get('BCRYPT_PROFILE', False)
+        if state.profile:
+            app.after_request(self._report_profile)
+        state.tracer = app.config.get('BCRYPT_TRACER')
+
+        salt_pool_size = app.config.get('BCRYPT_SALT_POOL_SIZE')
+        if salt_pool_size:
+            state.salt_pool = SaltPool(salt_pool_size)
+
+        # Initializing an app again replaces what was set up for it before.
+        previous = app.extensions.get('bcrypt')
+        if previous is not None:
+            state.owners = previous.owners
+            previous.shutdown_executor()
+        state.owners.add(self)
+        app.extensions['bcrypt'] = state
+        self._states.add(state)
+        self._default_state = state
+
+        app.cli.add_command(cli)
+
+        if app.config.get('BCRYPT_WARMUP', False):
+            self.warmup()
+
+    def calibrate(self, target_ms, max_seconds=5, cache_file=None,
+                  prefix=None):
+        '''Benchmarks bcrypt with the configured prefix and returns a
+        :data:`Calibration` holding the highest cost whose hash takes less
+        than `target_ms` milliseconds. Costs are tried from the minimum of 4
+        upwards and the search stops early once the next cost would exceed
+        `max_seconds` of total benchmarking. The minimum cost is returned if
+        even that exceeds the target.
+
+        :param target_ms: The latency budget of a single hash.
+        :param max_seconds: The maximum time spent benchmarking.
+        :param cache_file: An optional path used to store the result and
+                           load it again, so that many workers on the same
+                           machine only benchmark once. Workers starting
+                           together take turns through a lock on
+                           `cache_file + '.lock'`, so that they neither
+                           benchmark at the same time, skewing each other's
+                           timings, nor pick different costs.
+        :param prefix: The algorithm version to benchmark, by default the
+                       configured one.
+        '''
+        prefix = self._unicode_to_bytes(prefix or self._prefix)
+        key = {'target_ms': target_ms, 'prefix': prefix.decode('ascii')}
+        if cache_file is None:
+            return self._calibrate(target_ms, max_seconds, prefix)
+
+        calibration = _read_calibration(cache_file, key)
+        if calibration is not None:
+            return calibration
+        with _file_lock(cache_file + '.lock'):
+            # Another worker may have benchmarked while this one waited.
+            calibration = _read_calibration(cache_file, key)
+            if calibration is not None:
+                return calibration
+            calibration = self._calibrate(target_ms, max_seconds, prefix)
+            key.update(calibration._asdict())
+            directory = os.path.dirname(os.path.abspath(cache_file))
+            with tempfile.NamedTemporaryFile('w', dir=directory,
+                                             delete=False) as f:
+                json.dump(key, f)
+            os.replace(f.name, cache_file)
+        return calibration
+
+    def _calibrate(self, target_ms, max_seconds, prefix):
+        '''Benchmarks bcrypt for :meth:`calibrate`.'''
+        bcrypt = _bcrypt()
+
+        def measure(rounds):
+            salt = bcrypt.gensalt(rounds=rounds, prefix=prefix)
+            start = time.perf_counter()
+            bcrypt.hashpw(b'calibration', salt)
+            return (time.perf_counter() - start) * 1000
+
+        deadline = time.perf_counter() + max_seconds
+        rounds, measured_ms = 4, measure(4)
+        # Every extra round doubles the cost of a hash.
+        while (rounds < 31 and measured_ms * 2 < target_ms and
+               time.perf_counter() + measured_ms * 2 / 1000 < deadline):
+            rounds, measured_ms = rounds + 1, measure(rounds + 1)
+            if measured_ms >= target_ms:
+                rounds, measured_ms = rounds - 1, measured_ms / 2
+                break
+        return Calibration(rounds, measured_ms)
+
+    def get_executor(self):
+        '''Returns the executor hashing is dispatched to, or None if hashing
+        runs on the calling thread. A managed executor configured through
+        `BCRYPT_EXECUTOR` is started lazily on first use, one per app.'''
+        if self.executor is not None:
+            return self.executor
+        state = self._state()
+        if state.executor_type is None:
+            return None
+        if state.managed_executor is None:
+            with state.executor_lock:
+                if state.managed_executor is None:
+                    import concurrent.futures
+                    executor_class = getattr(
+                        concurrent.futures,
+                        _EXECUTOR_TYPES[state.executor_type])
+                    state.managed_executor = executor_class(
+                        max_workers=state.max_workers)
+        return state.managed_executor
+
+    def shutdown_executor(self, wait=True):
+        '''Shuts down the managed executors of the apps initialized with
+        this instance, if they have been started. They will be started again
+        on the next hash.
+
+        :param wait: Whether to wait for pending hashes to complete.'''
+        for state in list(self._states):
+            state.shutdown_executor(wait)
+
+    def _reset_executor(self):
+        '''Discards the managed executors without shutting them down, and
+        the pregenerated salts. Used in forked children, where the parent's
+        worker threads or processes are not usable and its salts are shared
+        with every other child.'''
+        for state in list(self._states):
+            state.reset_executor()
+
+    def warmup(self):
+        '''Does the work that would otherwise slow down the first hashes of
+        a new worker: imports the backend and runs a cheap hash with it,
+        starts the managed executor and each of its workers, and fills the
+        salt pool for the current settings. Call it from a `post_fork` hook
+        of gunicorn, or set `BCRYPT_WARMUP` to have `init_app` call it::
+
+            def post_fork(server, worker):
+                bcrypt.warmup()
+
+        Warming up before the fork, as `BCRYPT_WARMUP` does with a preloaded
+        app, imports the backend once for all workers, but the executor and
+        salt pool are discarded in each forked worker.
+        '''
+        settings = self._settings()
+        if settings.backend is None:
+            salt = _bcrypt().gensalt(rounds=4, prefix=settings.prefix_bytes)
+        else:
+            salt = settings.backend.gensalt(1)
+        _hashpw(b'warmup', salt)
+
+        executor = self.get_executor()
+        if executor is not None:
+            for future in [executor.submit(_hashpw, b'warmup', salt)
+                           for _ in range(self._worker_count())]:
+                future.result()
+
+        salt_pool = self.salt_pool
+        if salt_pool is not None and settings.backend is None:
+            salt_pool.fill(settings.log_rounds, settings.prefix_bytes)
+
+    def _worker_count(self):
+        '''Returns the number of workers hashing is spread over,
+        `BCRYPT_MAX_WORKERS` or, if it is not set, the number of cores.'''
+        return self._state().max_workers or os.cpu_count() or 1
 
     def _unicode_to_bytes(self, unicode_string):
         '''Converts a unicode string to a bytes object.
@@ -163,7 +1013,402 @@ class Bcrypt(object):
             bytes_object = unicode_string
         return bytes_object
 
-    def generate_password_hash(self, password, rounds=None, prefix=None):
+    def _hash_to_bytes(self, pw_hash):
+        '''Converts a hash given as a unicode string, bytes or
+        :class:`PasswordHash` to a bytes object.
+
+        :param pw_hash: The hash to convert.'''
+        if isinstance(pw_hash, PasswordHash):
+            return pw_hash.raw
+        return self._unicode_to_bytes(pw_hash)
+
+    def _state(self):
+        '''Returns the :class:`_AppState` of the current app or, outside of
+        the context of an app initialized with this instance, that of the
+        app initialized last, if any.'''
+        if has_app_context():
+            state = current_app.extensions.get('bcrypt')
+            if state is not None and self in state.owners:
+                return state
+        return self._default_state
+
+    def _settings(self):
+        '''Returns the settings of the current app, as overridden by the
+        blueprints handling the current request, or the settings of the app
+        initialized last outside of the context of an app initialized with
+        this instance.'''
+        state = self._state()
+        if (state.blueprints and has_request_context() and
+                current_app.extensions.get('bcrypt') is state):
+            for name in request.blueprints:
+                settings = state.blueprints.get(name)
+                if settings is not None:
+                    return settings
+        return state.settings
+
+    @property
+    def calibration(self):
+        '''The :data:`Calibration` of the current app, if it sets
+        `BCRYPT_TARGET_MS`.'''
+        return self._state().calibration
+
+    @property
+    def verification_cache(self):
+        '''The :class:`VerificationCache` of the current app, if enabled.'''
+        return self._state().verification_cache
+
+    @property
+    def limiter(self):
+        '''The :class:`HashingLimiter` of the current app, if enabled.'''
+        return self._state().limiter
+
+    @property
+    def rate_limiter(self):
+        '''The :class:`RateLimiter` of the current app, if enabled.'''
+        return self._state().rate_limiter
+
+    @property
+    def salt_pool(self):
+        '''The :class:`SaltPool` of the current app, if enabled.'''
+        return self._state().salt_pool
+
+    @property
+    def tracer(self):
+        '''The tracer given spans by the current app, if any.'''
+        return self._state().tracer
+
+    @property
+    def _log_rounds(self):
+        return self._settings().log_rounds
+
+    @property
+    def _prefix(self):
+        return self._settings().prefix
+
+    @property
+    def _handle_long_passwords(self):
+        return self._settings().handle_long_passwords
+
+    def _prepare_password(self, password, settings=None, prehash=None):
+        '''Encodes `password` as bytes and pre-hashes it with the `prehash`
+        strategy or, if there is none and long password handling is enabled,
+        replaces it with the hexdigest of its sha256 hash.
+
+        :param password: The password to prepare.
+        :param settings: The settings to apply, by default the current ones.
+        :param prehash: The name of the pre-hash strategy, if any.'''
+        # Python 3 unicode strings must be encoded as bytes before hashing.
+        password = self._unicode_to_bytes(password)
+        settings = settings or self._settings()
+
+        if prehash is not None:
+            strategy = _PREHASH_STRATEGIES.get(prehash)
+            if strategy is None:
+                raise ValueError(
+                    'Unknown pre-hash strategy {0!r}.'.format(prehash))
+            return strategy(password, settings.pepper)
+
+        if settings.handle_long_passwords:
+            password = hashlib.sha256(password).hexdigest()
+            password = self._unicode_to_bytes(password)
+
+        return password
+
+    def _prehash_marker(self, settings):
+        '''Returns the marker prepended to new hashes for the configured
+        pre-hash strategy, or an empty string if there is none.'''
+        if settings.prehash is None:
+            return b''
+        return _PREHASHED_PREFIX + settings.prehash.encode('ascii')
+
+    def _gensalt(self, rounds=None, prefix=None, settings=None):
+        '''Generates a bcrypt salt, falling back to the configured number of
+        rounds and prefix, or the salt of the configured :class:`KDFBackend`
+        with its own parameters. `rounds` and `prefix` are bcrypt settings
+        and do not apply to other backends, whose costs are not comparable:
+        12 rounds of bcrypt are not 12 iterations of PBKDF2.
+
+        :param rounds: The optional number of rounds.
+        :param prefix: The algorithm version to use.
+        :param settings: The settings to apply, by default the current ones.'''
+        settings = settings or self._settings()
+        if settings.backend is not None:
+            return settings.backend.gensalt()
+        if rounds is None:
+            rounds = settings.log_rounds
+        if prefix is None:
+            prefix = settings.prefix_bytes
+        else:
+            prefix = self._unicode_to_bytes(prefix)
+
+        salt_pool = self.salt_pool
+        if salt_pool is not None:
+            return salt_pool.take(rounds, prefix)
+        return _bcrypt().gensalt(rounds=rounds, prefix=prefix)
+
+    def _hashpw(self, password, salt, operation, parsed=None, limited=True):
+        '''Hashes `password` with `salt`, in the executor if one is
+        configured, once the request budget and the limiter admit it.
+
+        :param password: The prepared password.
+        :param salt: The salt or existing hash.
+        :param operation: Either `'generate'` or `'check'`.
+        :param parsed: The :class:`PasswordHash` of `salt`, if available.
+        :param limited: Whether to wait for the limiter, which background
+                        jobs bounding their own concurrency skip.'''
+        prefix, cost = _bcrypt_settings(parsed or salt)
+        timeout = self._charge_budget(prefix, cost)
+        self._begin_hash(operation, prefix, cost)
+        start = time.perf_counter()
+        limiter = self.limiter if limited else None
+        if limiter is not None:
+            self._acquire(limiter, timeout)
+        wait = time.perf_counter() - start
+        try:
+            executor = self.get_executor()
+            if executor is None:
+                hashed = _hashpw(password, salt)
+            else:
+                hashed = executor.submit(_hashpw, password, salt).result()
+        finally:
+            if limiter is not None:
+                limiter.release()
+        self._end_hash(operation, prefix, cost, start, wait,
+                       self._executor_name(executor, 'inline'))
+        return hashed
+
+    async def _async_hashpw(self, password, salt, operation, parsed=None):
+        '''The awaitable counterpart of :meth:`_hashpw`. Waiting for the
+        limiter does not occupy a thread.
+
+        :param password: The prepared password.
+        :param salt: The salt or existing hash.
+        :param operation: Either `'generate'` or `'check'`.
+        :param parsed: The :class:`PasswordHash` of `salt`, if available.'''
+        prefix, cost = _bcrypt_settings(parsed or salt)
+        timeout = self._charge_budget(prefix, cost)
+        self._begin_hash(operation, prefix, cost)
+        start = time.perf_counter()
+        limiter = self.limiter
+        if limiter is not None:
+            await self._async_acquire(limiter, timeout)
+        wait = time.perf_counter() - start
+        try:
+            hashed = await self._run_in_executor(_hashpw, password, salt)
+        finally:
+            if limiter is not None:
+                limiter.release()
+        self._end_hash(operation, prefix, cost, start, wait,
+                       self._executor_name(self.get_executor(), 'loop'))
+        return hashed
+
+    def _acquire(self, limiter, timeout=None):
+        '''Waits for admission by `limiter`, counting rejections.'''
+        try:
+            limiter.acquire(timeout)
+        except HashingSaturatedError:
+            self.metrics.increment('rejected')
+            raise
+
+    async def _async_acquire(self, limiter, timeout=None):
+        '''The awaitable counterpart of :meth:`_acquire`.'''
+        try:
+            await limiter.async_acquire(timeout)
+        except HashingSaturatedError:
+            self.metrics.increment('rejected')
+            raise
+
+    def set_request_budget(self, max_operations=None, timeout=None):
+        '''Limits the hashing done during the current request to at most
+        `max_operations` hashes, each of which must be expected to finish
+        within `timeout` seconds from now. Replaces any budget set before,
+        including the one configured for every request::
+
+            bcrypt.set_request_budget(max_operations=1, timeout=0.5)
+
+        Returns the new :class:`HashingBudget`.
+
+        :param max_operations: The maximum number of hashes, or None.
+        :param timeout: The number of seconds left, or None.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        budget = g._bcrypt_budget = HashingBudget(max_operations, deadline)
+        return budget
+
+    def get_request_budget(self):
+        '''Returns the :class:`HashingBudget` of the current request, or
+        None if there is none.'''
+        if not has_app_context():
+            return None
+        return g.get('_bcrypt_budget')
+
+    def _start_request_budget(self):
+        '''Sets the budget configured for every request.'''
+        state = self._state()
+        timeout = state.request_timeout
+        if state.request_timeout_header is not None:
+            try:
+                header = float(request.headers[state.request_timeout_header])
+            except (KeyError, ValueError):
+                pass
+            else:
+                timeout = header if timeout is None else min(timeout, header)
+        if state.request_max_operations is not None or timeout is not None:
+            self.set_request_budget(state.request_max_operations, timeout)
+
+    def _estimate_seconds(self, prefix, cost):
+        '''Estimates the duration of a hash at `cost` from the hashes seen
+        so far or, failing that, the calibration. For bcrypt every extra
+        round doubles the duration; other backends are only estimated from
+        hashes with the same settings.'''
+        if cost is None:
+            return 0.0
+        if (prefix, cost) in self._cost_seconds:
+            return self._cost_seconds[prefix, cost]
+        if prefix not in _BCRYPT_PREFIXES:
+            return 0.0
+        known = [key for key in self._cost_seconds
+                 if key[0] in _BCRYPT_PREFIXES]
+        if known:
+            known = min(known, key=lambda key: abs(key[1] - cost))
+            return self._cost_seconds[known] * 2.0 ** (cost - known[1])
+        calibration = self.calibration
+        if calibration is not None:
+            return (calibration.measured_ms / 1000 *
+                    2.0 ** (cost - calibration.log_rounds))
+        return 0.0
+
+    def _charge_budget(self, prefix, cost):
+        '''Counts a hash with `prefix` at `cost` against the request budget,
+        raising :exc:`HashingBudgetExceededError` if it does not fit. Returns
+        the number of seconds that may be spent waiting for the limiter, or
+        None if that is not limited.'''
+        budget = self.get_request_budget()
+        if budget is None:
+            return None
+        if (budget.max_operations is not None and
+                budget.operations >= budget.max_operations):
+            self.metrics.increment('budget_exceeded')
+            raise HashingBudgetExceededError(
+                'The request may not hash any more passwords.')
+        timeout = None
+        remaining = budget.remaining_seconds()
+        if remaining is not None:
+            timeout = remaining - self._estimate_seconds(prefix, cost)
+            if timeout <= 0:
+                self.metrics.increment('budget_exceeded')
+                raise HashingBudgetExceededError(
+                    'The request deadline does not leave time to hash.')
+        budget.operations += 1
+        return timeout
+
+    def _begin_hash(self, operation, prefix, cost):
+        '''Sends :data:`hash_started`.'''
+        if hash_started.receivers:
+            hash_started.send(self, operation=operation, cost=cost,
+                              prefix=prefix)
+
+    def _end_hash(self, operation, prefix, cost, start, wait,
+                  executor=None):
+        '''Records a finished hash, sends :data:`hash_finished` and, if
+        profiling or tracing, records its :data:`HashingSpan`.'''
+        elapsed = time.perf_counter() - start
+        duration = elapsed - wait
+        self.metrics.observe(operation, cost, prefix, duration, wait)
+        if cost is not None:
+            # An exponentially weighted average smooths out outliers.
+            previous = self._cost_seconds.get((prefix, cost), duration)
+            self._cost_seconds[prefix, cost] = 0.8 * previous + 0.2 * duration
+        if hash_finished.receivers:
+            hash_finished.send(self, operation=operation, cost=cost,
+                               prefix=prefix, duration=duration, wait=wait)
+        state = self._state()
+        if state.profile or state.tracer is not None:
+            span = HashingSpan(operation, prefix, cost, executor,
+                               time.time() - elapsed, wait, duration)
+            if state.profile and has_app_context():
+                g.setdefault('_bcrypt_spans', []).append(span)
+            if state.tracer is not None:
+                self._trace(state.tracer, span)
+
+    def _executor_name(self, executor, default):
+        '''Names `executor` for a :data:`HashingSpan`.'''
+        if executor is None:
+            return default
+        state = self._state()
+        if executor is state.managed_executor:
+            return state.executor_type
+        return type(executor).__name__
+
+    def _trace(self, tracer, span):
+        '''Reports `span` to the OpenTelemetry-compatible `tracer`, with an
+        event marking the end of the wait for the limiter.'''
+        attributes = {'bcrypt.operation': span.operation,
+                      'bcrypt.executor': span.executor,
+                      'bcrypt.wait_ms': span.wait * 1000,
+                      'bcrypt.duration_ms': span.duration * 1000}
+        # OpenTelemetry attributes may not be None.
+        if span.prefix is not None:
+            attributes['bcrypt.prefix'] = span.prefix
+        if span.cost is not None:
+            attributes['bcrypt.cost'] = span.cost
+        start = int(span.start * 1e9)
+        admitted = start + int(span.wait * 1e9)
+        traced = tracer.start_span('bcrypt.' + span.operation,
+                                        attributes=attributes,
+                                        start_time=start)
+        traced.add_event('bcrypt.admitted', timestamp=admitted)
+        traced.end(end_time=admitted + int(span.duration * 1e9))
+
+    def get_request_spans(self):
+        '''Returns the :data:`HashingSpan` tuples recorded so far during the
+        current request, oldest first. Spans are only recorded if
+        `BCRYPT_PROFILE` is set.'''
+        if not has_app_context():
+            return []
+        return list(g.get('_bcrypt_spans', ()))
+
+    def _report_profile(self, response):
+        '''Adds a `Server-Timing` header to `response` and logs the hashing
+        done during the request, if any.'''
+        spans = self.get_request_spans()
+        if not spans:
+            return response
+        duration = sum(span.duration for span in spans) * 1000
+        wait = sum(span.wait for span in spans) * 1000
+        response.headers.add(
+            'Server-Timing',
+            'bcrypt;dur={0:.1f};desc="{1} hashes", '
+            'bcrypt-wait;dur={2:.1f}'.format(duration, len(spans), wait))
+        current_app.logger.info(
+            '%s %s spent %.1f ms hashing and %.1f ms waiting: %s',
+            request.method, request.path, duration, wait,
+            ', '.join('{0} {1}/{2} on {3} {4:.1f}+{5:.1f} ms'.format(
+                span.operation, span.prefix, span.cost, span.executor,
+                span.wait * 1000, span.duration * 1000) for span in spans))
+        return response
+
+    def _cached(self, pw_hash, password):
+        '''Tells whether the verification cache holds a successful
+        verification of `password` against `pw_hash`.'''
+        cache = self.verification_cache
+        if cache is not None and cache.get(pw_hash, password):
+            self.metrics.increment('cache_hit')
+            return True
+        return False
+
+    def _verify(self, pw_hash, password, valid):
+        '''Records the result of verifying `password` against `pw_hash`.'''
+        self.metrics.increment('check_success' if valid else 'check_failure')
+        cache = self.verification_cache
+        if valid and cache is not None:
+            cache.add(pw_hash, password)
+        return valid
+
+    def generate_password_hash(self, password, rounds=None, prefix=None,
+                               parsed=False):
         '''Generates a password hash using bcrypt. Specifying `rounds`
         sets the log_rounds parameter of `bcrypt.gensalt()` which determines
         the complexity of the salt. 12 is the default value. Specifying `prefix`
@@ -175,31 +1420,32 @@ class Bcrypt(object):
 
             pw_hash = bcrypt.generate_password_hash('secret', 10)
 
+        Pass `parsed=True` to receive a :class:`PasswordHash` rather than
+        bytes.
+
+        If `BCRYPT_BACKEND` selects another key derivation function, `rounds`
+        and `prefix` are ignored and the backend's own parameters are used.
+
         :param password: The password to be hashed.
         :param rounds: The optional number of rounds.
         :param prefix: The algorithm version to use.
+        :param parsed: Whether to return a :class:`PasswordHash`.
         '''
 
         if not password:
             raise ValueError('Password must be non-empty.')
 
-        if rounds is None:
-            rounds = self._log_rounds
-        if prefix is None:
-            prefix = self._prefix
-
-        # Python 3 unicode strings must be encoded as bytes before hashing.
-        password = self._unicode_to_bytes(password)
-        prefix = self._unicode_to_bytes(prefix)
-
-        if self._handle_long_passwords:
-            password = hashlib.sha256(password).hexdigest()
-            password = self._unicode_to_bytes(password)
-
-        salt = bcrypt.gensalt(rounds=rounds, prefix=prefix)
-        return bcrypt.hashpw(password, salt)
+        settings = self._settings()
+        password = self._prepare_password(password, settings,
+                                          settings.prehash)
+        salt = self._gensalt(rounds, prefix, settings)
+        pw_hash = (self._prehash_marker(settings) +
+                   self._hashpw(password, salt, 'generate'))
+        if parsed:
+            return PasswordHash(pw_hash)
+        return pw_hash
 
-    def check_password_hash(self, pw_hash, password):
+    def check_password_hash(self, pw_hash, password, identity=None):
         '''Tests a password hash against a candidate password. The candidate
         password is first hashed and then subsequently compared in constant
         time to the existing hash. This will either return `True` or `False`.
@@ -210,16 +1456,1699 @@ class Bcrypt(object):
             pw_hash = bcrypt.generate_password_hash('secret', 10)
             bcrypt.check_password_hash(pw_hash, 'secret') # returns True
 
+        `pw_hash` may also be a :class:`PasswordHash`, in which case it is
+        not parsed again.
+
+        If rate limiting is configured, attempts are counted against
+        `identity`, a string or a list of strings such as a username and a
+        client address, and :exc:`RateLimitExceededError` is raised before
+        any hashing once an identity has no attempts left.
+
         :param pw_hash: The hash to be compared against.
         :param password: The password to compare.
+        :param identity: The optional identity of the caller.
         '''
 
+        self._rate_limit(identity)
+        parsed = pw_hash if isinstance(pw_hash, PasswordHash) else None
         # Python 3 unicode strings must be encoded as bytes before hashing.
-        pw_hash = self._unicode_to_bytes(pw_hash)
-        password = self._unicode_to_bytes(password)
+        pw_hash = self._hash_to_bytes(pw_hash)
+        target, password = self._split_hash(pw_hash, password)
 
-        if self._handle_long_passwords:
-            password = hashlib.sha256(password).hexdigest()
-            password = self._unicode_to_bytes(password)
+        if self._cached(pw_hash, password):
+            return True
+        candidate = self._hashpw(password, target, 'check', parsed)
+        return self._verify(pw_hash, password,
+                            hmac.compare_digest(candidate, target))
+
+    def _rate_limit(self, identity):
+        '''Takes an attempt from the buckets of `identity`, raising
+        :exc:`RateLimitExceededError` if one of them is empty.'''
+        rate_limiter = self.rate_limiter
+        if identity is None or rate_limiter is None:
+            return
+        try:
+            rate_limiter.consume(identity)
+        except RateLimitExceededError:
+            self.metrics.increment('rate_limited')
+            raise
+
+    def _split_hash(self, pw_hash, password):
+        '''Returns the hash within `pw_hash` that hashing the password must
+        reproduce and the password prepared for it, which for a pre-hashed
+        hash is the output of its pre-hash strategy. Werkzeug hashes, plain
+        or wrapped, are returned whole with the password as bytes, see
+        :func:`_hashpw`.
+
+        :param pw_hash: The hash as bytes.
+        :param password: The password to compare.'''
+        if pw_hash.startswith(_WERKZEUG_PREFIXES + (_WRAPPED_PREFIX,)):
+            return pw_hash, self._unicode_to_bytes(password)
+        prehash, pw_hash = _split_prehash(pw_hash)
+        return pw_hash, self._prepare_password(password, prehash=prehash)
+
+    def wrap_legacy_hash(self, legacy_hash, rounds=None, prefix=None):
+        '''Upgrades a werkzeug `pbkdf2:` or `scrypt:` hash without knowing
+        the password, by hashing its digest with bcrypt. The result is
+        verified by :meth:`check_password_hash` like any other hash::
+
+            user.pw_hash = bcrypt.wrap_legacy_hash(user.pw_hash)
+
+        :param legacy_hash: The werkzeug hash.
+        :param rounds: The optional number of rounds.
+        :param prefix: The algorithm version to use.
+        :raises ValueError: If `legacy_hash` is not a supported werkzeug hash.
+        '''
+        return self._wrap_legacy_hash(legacy_hash, rounds, prefix)
+
+    def _wrap_legacy_hash(self, legacy_hash, rounds=None, prefix=None,
+                          limited=True):
+        '''Implements :meth:`wrap_legacy_hash`, optionally without waiting
+        for the limiter.'''
+        legacy_hash = self._unicode_to_bytes(legacy_hash)
+        if not legacy_hash.startswith(_WERKZEUG_PREFIXES):
+            raise ValueError('Not a werkzeug hash.')
+        method, salt, digest = legacy_hash.decode('ascii').split('$', 2)
+        # Fails early for methods _werkzeug_digest cannot recompute.
+        _werkzeug_digest(method, salt, b'')
+        wrapped = self._hashpw(_wrapped_password(digest),
+                               self._gensalt(rounds, prefix), 'generate',
+                               limited=limited)
+        header = '{0}{1}${2}'.format(_WRAPPED_PREFIX.decode('ascii'), method,
+                                     salt)
+        return header.encode('ascii') + wrapped
+
+    def invalidate_cached(self, pw_hash):
+        '''Forgets any cached successful verification of `pw_hash`. Call this
+        when a user's hash is replaced or removed. Does nothing if the
+        verification cache is disabled.
+
+        :param pw_hash: The hash to be forgotten.
+        '''
+        cache = self.verification_cache
+        if cache is not None:
+            cache.invalidate(self._hash_to_bytes(pw_hash))
+
+    def needs_rehash(self, pw_hash):
+        '''Tells whether `pw_hash` was generated with a cost, prefix,
+        pre-hash strategy or :class:`KDFBackend` other than the configured
+        ones. Only the hash string is inspected, no hashing takes place, so
+        this is cheap enough to call on every login. Hashes that cannot be
+        parsed are reported as needing a rehash.
+
+        Note that the bcrypt format does not record whether a hash was made
+        with `BCRYPT_HANDLE_LONG_PASSWORDS`, so that setting is not taken
+        into account. Hashes made with `BCRYPT_PREHASH` do record their
+        strategy.
+
+        :param pw_hash: The hash to be inspected.
+        '''
+        if isinstance(pw_hash, PasswordHash):
+            prehash = pw_hash.prehash
+        else:
+            prehash, pw_hash = _split_prehash(self._unicode_to_bytes(pw_hash))
+        settings = self._settings()
+        if prehash != settings.prehash:
+            return True
+        if settings.backend is not None:
+            if isinstance(pw_hash, PasswordHash):
+                pw_hash = _split_prehash(pw_hash.raw)[1]
+            return settings.backend.needs_rehash(pw_hash)
+        prefix, cost = _bcrypt_settings(pw_hash)
+        return prefix != settings.prefix or cost != settings.log_rounds
+
+    def dummy_check(self, password=None, identity=None):
+        '''Spends as long as :meth:`check_password_hash` would on a hash with
+        the current settings, then returns False. Use it when a login names
+        an unknown user, so that response times do not reveal which users
+        exist::
+
+            user = User.query.filter_by(name=name).first()
+            if user is None:
+                return bcrypt.dummy_check(candidate, identity=name)
+            return bcrypt.check_password_hash(user.pw_hash, candidate,
+                                              identity=name)
+
+        A dummy hash is made up from a fresh salt for each cost and prefix
+        when first needed, without any hashing, and the check goes through
+        the same executor, limiter and budget as a real one.
+
+        :param password: The candidate password, if any.
+        :param identity: The optional identity of the caller.
+        '''
+        self._rate_limit(identity)
+        settings = self._settings()
+        password = self._prepare_password(password or b'dummy password',
+                                          settings, settings.prehash)
+        self._hashpw(password, self._get_dummy_hash(), 'check')
+        return False
+
+    async def async_dummy_check(self, password=None, identity=None):
+        '''The awaitable counterpart of :meth:`dummy_check`.
+
+        :param password: The candidate password, if any.
+        :param identity: The optional identity of the caller.
+        '''
+        self._rate_limit(identity)
+        settings = self._settings()
+        password = self._prepare_password(password or b'dummy password',
+                                          settings, settings.prehash)
+        await self._async_hashpw(password, self._get_dummy_hash(), 'check')
+        return False
+
+    def _get_dummy_hash(self):
+        '''Returns a well-formed hash with the current cost and prefix. The
+        digest is random, as bcrypt only uses the salt part of a hash to
+        verify a password against it. For other backends the salt is used
+        as it is.'''
+        settings = self._settings()
+        key = (settings.log_rounds, settings.prefix, settings.backend)
+        dummy = self._dummy_hashes.get(key)
+        if dummy is None:
+            dummy = self._gensalt(settings=settings)
+            if settings.backend is None:
+                # The digest uses the same 64 character alphabet as the salt.
+                gensalt = _bcrypt().gensalt
+                dummy += gensalt()[-22:] + gensalt()[-9:]
+            self._dummy_hashes[key] = dummy
+        return dummy
+
+    def check_and_rehash(self, pw_hash, password, identity=None):
+        '''Tests a password hash against a candidate password like
+        :meth:`check_password_hash` and, if it matches but
+        :meth:`needs_rehash` reports it as stale, also generates a
+        replacement hash with the current settings. A tuple of the result and
+        the new hash, or None if no new hash is needed, is returned::
+
+            valid, new_hash = bcrypt.check_and_rehash(user.pw_hash, candidate)
+            if new_hash is not None:
+                user.pw_hash = new_hash
+
+        The rehash is optional: if the request budget or the limiter refuse
+        it, the login still succeeds and the hash is left for a later one.
+
+        :param pw_hash: The hash to be compared against.
+        :param password: The password to compare.
+        :param identity: The optional identity of the caller.
+        '''
+        if not self.check_password_hash(pw_hash, password, identity):
+            return False, None
+        if not self.needs_rehash(pw_hash):
+            return True, None
+        try:
+            new_hash = self.generate_password_hash(password)
+        except HashingSaturatedError:
+            return True, None
+        self.invalidate_cached(pw_hash)
+        self.metrics.increment('rehash')
+        return True, new_hash
+
+    def generate_password_hashes(self, passwords, rounds=None, prefix=None,
+                                 ordered=True):
+        '''Generates password hashes for many passwords at once, spreading
+        the work over the configured executor or, if there is none, a thread
+        pool sized to the number of cores. Results are streamed back as a
+        generator while only a bounded number of hashes is in flight, so
+        arbitrarily large iterables may be passed::
+
+            for pw_hash in bcrypt.generate_password_hashes(passwords):
+                ...
+
+        The hashes are identical in format to those of
+        :meth:`generate_password_hash`.
+
+        :param passwords: An iterable of passwords to be hashed.
+        :param rounds: The optional number of rounds.
+        :param prefix: The algorithm version to use.
+        :param ordered: If True, hashes are yielded in input order. Otherwise
+                        `(index, pw_hash)` tuples are yielded as they complete.
+        '''
+
+        settings = self._settings()
+        marker = self._prehash_marker(settings)
+
+        def jobs():
+            for password in passwords:
+                if not password:
+                    raise ValueError('Password must be non-empty.')
+                yield (self._prepare_password(password, settings,
+                                              settings.prehash),
+                       self._gensalt(rounds, prefix, settings))
+
+        return self._map_hashpw(jobs(), lambda salt, hashed: marker + hashed,
+                                ordered)
+
+    def check_password_hashes(self, pairs, ordered=True):
+        '''Tests many `(pw_hash, password)` pairs at once, spreading the work
+        like :meth:`generate_password_hashes` does. A generator of booleans
+        is returned::
+
+            results = list(bcrypt.check_password_hashes(zip(hashes, passwords)))
+
+        :param pairs: An iterable of `(pw_hash, password)` tuples.
+        :param ordered: If True, results are yielded in input order. Otherwise
+                        `(index, result)` tuples are yielded as they complete.
+        '''
+
+        def jobs():
+            for pw_hash, password in pairs:
+                target, password = self._split_hash(
+                    self._hash_to_bytes(pw_hash), password)
+                yield password, target
+
+        return self._map_hashpw(jobs(), hmac.compare_digest, ordered)
+
+    def _map_hashpw(self, jobs, finish, ordered):
+        '''Runs `bcrypt.hashpw` over `(password, salt)` jobs in an executor,
+        keeping at most a few hashes per worker in flight, and yields
+        `finish(salt, hashed)` for each job.
+
+        :param jobs: An iterable of prepared `(password, salt)` tuples.
+        :param finish: Callable mapping the salt and hash to a result.
+        :param ordered: Whether to yield in input order.'''
+        executor = self.get_executor()
+        owned = executor is None
+        if owned:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=self._worker_count())
+        limit = 2 * self._worker_count()
+
+        pending = deque()
+        try:
+            for index, (password, salt) in enumerate(jobs):
+                if len(pending) >= limit:
+                    for result in self._drain(pending, finish, ordered):
+                        yield result
+                future = executor.submit(_hashpw, password, salt)
+                pending.append((index, salt, future))
+            while pending:
+                for result in self._drain(pending, finish, ordered):
+                    yield result
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            if owned:
+                executor.shutdown(wait=True)
+
+    def _drain(self, pending, finish, ordered):
+        '''Waits for the oldest pending job, or for any job if not `ordered`,
+        and returns the finished results it can remove from `pending`.'''
+        if ordered:
+            index, salt, future = pending.popleft()
+            return [finish(salt, future.result())]
+
+        from concurrent.futures import FIRST_COMPLETED, wait
+        done, _ = wait([job[2] for job in pending],
+                       return_when=FIRST_COMPLETED)
+        results = []
+        for job in [job for job in pending if job[2] in done]:
+            pending.remove(job)
+            index, salt, future = job
+            results.append((index, finish(salt, future.result())))
+        return results
+
+    async def async_generate_password_hash(self, password, rounds=None,
+                                           prefix=None):
+        '''The awaitable counterpart of :meth:`generate_password_hash`. The
+        bcrypt computation is dispatched to an executor, leaving the event
+        loop free while the hash is generated::
+
+            pw_hash = await bcrypt.async_generate_password_hash('secret', 10)
+
+        :param password: The password to be hashed.
+        :param rounds: The optional number of rounds.
+        :param prefix: The algorithm version to use.
+        '''
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        settings = self._settings()
+        password = self._prepare_password(password, settings,
+                                          settings.prehash)
+        salt = self._gensalt(rounds, prefix, settings)
+        return (self._prehash_marker(settings) +
+                await self._async_hashpw(password, salt, 'generate'))
+
+    async def async_check_password_hash(self, pw_hash, password,
+                                        identity=None):
+        '''The awaitable counterpart of :meth:`check_password_hash`. The
+        candidate password is hashed in an executor and the result compared in
+        constant time to the existing hash::
+
+            await bcrypt.async_check_password_hash(pw_hash, 'secret')
+
+        :param pw_hash: The hash to be compared against.
+        :param password: The password to compare.
+        :param identity: The optional identity of the caller.
+        '''
+
+        self._rate_limit(identity)
+        parsed = pw_hash if isinstance(pw_hash, PasswordHash) else None
+        pw_hash = self._hash_to_bytes(pw_hash)
+        target, password = self._split_hash(pw_hash, password)
+
+        if self._cached(pw_hash, password):
+            return True
+        candidate = await self._async_hashpw(password, target, 'check',
+                                             parsed)
+        return self._verify(pw_hash, password,
+                            hmac.compare_digest(candidate, target))
+
+    async def _run_in_executor(self, func, *args):
+        '''Runs `func` in the configured executor, or the loop's default
+        executor, without blocking the running event loop.
+
+        :param func: The blocking callable.
+        :param args: The positional arguments passed to `func`.'''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(),
+                                          functools.partial(func, *args))
+
+
+class HashingBudget(object):
+    '''The hashing budget of a request, see
+    :meth:`Bcrypt.set_request_budget`.
+
+    :param max_operations: The maximum number of hashes, or None.
+    :param deadline: The :func:`time.monotonic` time by which hashing must
+                     be done, or None.
+    '''
+
+    def __init__(self, max_operations=None, deadline=None):
+        self.max_operations = max_operations
+        self.deadline = deadline
+        self.operations = 0
+
+    def remaining_operations(self):
+        '''Returns the number of hashes left, or None if unlimited.'''
+        if self.max_operations is None:
+            return None
+        return max(0, self.max_operations - self.operations)
+
+    def remaining_seconds(self):
+        '''Returns the number of seconds left, or None if unlimited.'''
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
+class PasswordHash(object):
+    '''A bcrypt hash parsed once into its parts, so that verification and
+    rehash decisions need no further decoding or splitting. The parts are
+    available as `prefix` (e.g. `'2b'`), `cost` (the log rounds), and `salt`
+    and `digest`, which are memoryview slices of the original bytes `raw`.
+    The pre-hash strategy of hashes made with `BCRYPT_PREHASH` is available
+    as `prehash`, which is None for other hashes.
+
+    Hashes of another :class:`KDFBackend` are parsed as well, in which case
+    `backend` is that backend, `prefix` and `cost` are the identifier and
+    cost it reports, e.g. `'pbkdf2-sha256'` and the number of iterations,
+    and `salt` and `digest` are its last two fields. `backend` is None for
+    bcrypt hashes::
+
+        pw_hash = PasswordHash(user.pw_hash)
+        if pw_hash.cost < 12:
+            ...
+        bcrypt.check_password_hash(pw_hash, candidate)
+
+    Instances compare equal to the bytes or string they were parsed from.
+    Use :meth:`decode` or `bytes()` to store them.
+
+    :param pw_hash: The hash as a unicode string or bytes.
+    :raises ValueError: If `pw_hash` is neither a bcrypt hash nor a hash
+                        of a registered :class:`KDFBackend`.
+    '''
+
+    __slots__ = ('raw', 'prehash', 'backend', 'prefix', 'cost', 'salt',
+                 'digest')
+
+    def __init__(self, pw_hash):
+        if isinstance(pw_hash, str):
+            pw_hash = pw_hash.encode('utf-8')
+        self.raw = pw_hash
+        self.prehash, bcrypt_hash = _split_prehash(pw_hash)
+        start = len(pw_hash) - len(bcrypt_hash)
+        pw_hash = bcrypt_hash
+        view = memoryview(self.raw)
+        self.backend = _kdf_backend(pw_hash)
+        if self.backend is not None:
+            self.prefix, self.cost = self.backend.settings(pw_hash)
+            if self.prefix is None or pw_hash.count(b'$') < 3:
+                raise ValueError('Not a {0} hash.'.format(
+                    pw_hash.split(b'$')[1].decode('ascii', 'replace')))
+            digest = start + pw_hash.rindex(b'$')
+            salt = start + pw_hash.rindex(b'$', 0, digest - start)
+            self.salt = view[salt + 1:digest]
+            self.digest = view[digest + 1:]
+            return
+        # b'$2b$12$' followed by a 22 character salt and a 31 character digest
+        if (len(pw_hash) != 60 or pw_hash[0:1] != b'$' or
+                pw_hash[3:4] != b'$' or pw_hash[6:7] != b'$' or
+                not pw_hash[4:6].isdigit()):
+            raise ValueError('Not a bcrypt hash.')
+        self.prefix = pw_hash[1:3].decode('ascii')
+        self.cost = int(pw_hash[4:6])
+        self.salt = view[start + 7:start + 29]
+        self.digest = view[start + 29:]
+
+    def __bytes__(self):
+        return self.raw
+
+    def __str__(self):
+        return self.decode()
+
+    def __repr__(self):
+        if self.backend is not None:
+            return '<PasswordHash ${0}${1}$...>'.format(self.prefix,
+                                                       self.cost)
+        return '<PasswordHash ${0}${1:02d}$...>'.format(self.prefix, self.cost)
+
+    def __eq__(self, other):
+        if isinstance(other, PasswordHash):
+            other = other.raw
+        elif isinstance(other, str):
+            other = other.encode('utf-8')
+        elif not isinstance(other, bytes):
+            return NotImplemented
+        return self.raw == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def decode(self, encoding='utf-8'):
+        '''Returns the hash as a unicode string.'''
+        return self.raw.decode(encoding)
+
+
+def _b64encode(data):
+    return base64.b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.b64decode(data + b'=' * (-len(data) % 4))
+
+
+class KDFBackend(object):
+    '''The interface of the key derivation functions :class:`Bcrypt` can
+    hash passwords with, selected by `BCRYPT_BACKEND`. Like bcrypt's, the
+    hashes of a backend start with `$<ident>$`, followed by the parameters
+    and salt and finally the digest, so that hashing a password with an
+    existing hash as the salt reproduces the hash if the password matches.
+
+    Hashes are verified by the backend registered for their `ident`,
+    whatever backend is configured, so backends may be changed at any time
+    and :meth:`Bcrypt.check_and_rehash` moves users to the configured one.
+    '''
+
+    #: The identifiers of the hashes made by this backend.
+    idents = ()
+
+    def gensalt(self, rounds=None):
+        '''Returns the start of a new hash, up to and including the salt.
+
+        :param rounds: The optional cost, overriding the backend's own.'''
+        raise NotImplementedError
+
+    def hashpw(self, password, salt):
+        '''Returns the hash of `password` with the parameters and salt of
+        `salt`, which may also be a complete hash.
+
+        :param password: The prepared password as bytes.
+        :param salt: The salt or hash as bytes.'''
+        raise NotImplementedError
+
+    def settings(self, pw_hash):
+        '''Returns the identifier and cost of `pw_hash`, as used for
+        metrics and request budgets, or `(None, None)` if it cannot be
+        parsed.
+
+        :param pw_hash: The salt or hash as bytes.'''
+        raise NotImplementedError
+
+    def needs_rehash(self, pw_hash):
+        '''Tells whether `pw_hash` was not made by this backend with its
+        current parameters.
+
+        :param pw_hash: The hash as bytes.'''
+        raise NotImplementedError
+
+
+class PBKDF2Backend(KDFBackend):
+    '''PBKDF2 with HMAC, from `hashlib`, for deployments that need an
+    algorithm approved by FIPS 140. Hashes look like
+    `$pbkdf2-sha256$600000$<salt>$<digest>`.
+
+    :param digest: The name of the HMAC digest.
+    :param iterations: The number of iterations.
+    :param salt_size: The number of random bytes in a salt.
+    '''
+
+    idents = ('pbkdf2-sha256', 'pbkdf2-sha512')
+
+    def __init__(self, digest='sha256', iterations=600000, salt_size=16):
+        self.ident = 'pbkdf2-' + digest
+        if self.ident not in self.idents:
+            raise ValueError('Unsupported PBKDF2 digest {0!r}.'.format(digest))
+        self.digest = digest
+        self.iterations = iterations
+        self.salt_size = salt_size
+
+    def gensalt(self, rounds=None):
+        header = '${0}${1}$'.format(self.ident, rounds or self.iterations)
+        return header.encode('ascii') + _b64encode(os.urandom(self.salt_size))
+
+    def hashpw(self, password, salt):
+        parts = salt.split(b'$')
+        if (len(parts) not in (4, 5) or parts[0] or not parts[2].isdigit() or
+                parts[1].decode('ascii', 'replace') not in self.idents):
+            raise ValueError('Invalid salt')
+        digest = parts[1][len(b'pbkdf2-'):].decode('ascii')
+        derived = hashlib.pbkdf2_hmac(digest, password, _b64decode(parts[3]),
+                                      int(parts[2]))
+        return b'$'.join(parts[:4] + [_b64encode(derived)])
+
+    def settings(self, pw_hash):
+        parts = pw_hash.split(b'$')
+        if len(parts) not in (4, 5) or parts[0] or not parts[2].isdigit():
+            return None, None
+        return parts[1].decode('ascii', 'replace'), int(parts[2])
+
+    def needs_rehash(self, pw_hash):
+        return self.settings(pw_hash) != (self.ident, self.iterations)
+
+
+class Argon2Backend(KDFBackend):
+    '''Argon2id, the memory-hard winner of the Password Hashing
+    Competition, which trades memory for CPU time. Requires the optional
+    `argon2-cffi` package. Hashes use the standard encoding, e.g.
+    `$argon2id$v=19$m=65536,t=3,p=4$<salt>$<digest>`.
+
+    :param time_cost: The number of iterations.
+    :param memory_cost: The memory used, in kibibytes.
+    :param parallelism: The number of lanes.
+    :param hash_len: The length of the digest in bytes.
+    :param salt_len: The length of the salt in bytes.
+    '''
+
+    idents = ('argon2id',)
+
+    def __init__(self, time_cost=3, memory_cost=65536, parallelism=4,
+                 hash_len=32, salt_len=16):
+        self.time_cost = time_cost
+        self.memory_cost = memory_cost
+        self.parallelism = parallelism
+        self.hash_len = hash_len
+        self.salt_len = salt_len
+
+    def gensalt(self, rounds=None):
+        header = '$argon2id$v=19$m={0},t={1},p={2}$'.format(
+            self.memory_cost, rounds or self.time_cost, self.parallelism)
+        return header.encode('ascii') + _b64encode(os.urandom(self.salt_len))
+
+    def _parse(self, pw_hash):
+        '''Returns the fields of `pw_hash` and its parameters by name.'''
+        parts = pw_hash.split(b'$')
+        if len(parts) not in (5, 6) or parts[0] or parts[1] != b'argon2id':
+            raise ValueError('Invalid salt')
+        params = dict(param.split(b'=', 1) for param in parts[3].split(b','))
+        return parts, {key.decode('ascii'): int(value)
+                       for key, value in params.items()}
+
+    def hashpw(self, password, salt):
+        try:
+            from argon2.low_level import Type, hash_secret
+        except ImportError as e:
+            print('argon2-cffi is required to use the argon2id backend')
+            raise e
+        parts, params = self._parse(salt)
+        hash_len = self.hash_len
+        if len(parts) == 6:
+            hash_len = len(_b64decode(parts[5]))
+        return hash_secret(password, _b64decode(parts[4]),
+                           time_cost=params['t'], memory_cost=params['m'],
+                           parallelism=params['p'], hash_len=hash_len,
+                           type=Type.ID,
+                           version=int(parts[2].partition(b'=')[2]))
+
+    def settings(self, pw_hash):
+        try:
+            parts, params = self._parse(pw_hash)
+        except ValueError:
+            return None, None
+        return 'argon2id', params.get('t')
+
+    def needs_rehash(self, pw_hash):
+        try:
+            parts, params = self._parse(pw_hash)
+        except ValueError:
+            return True
+        return params != {'m': self.memory_cost, 't': self.time_cost,
+                          'p': self.parallelism}
+
+
+# The backends verifying hashes other than bcrypt's, by ident. Hashes carry
+# all their parameters, so instances with default parameters suffice.
+_KDF_BACKENDS = {
+    'pbkdf2-sha256': PBKDF2Backend('sha256'),
+    'pbkdf2-sha512': PBKDF2Backend('sha512'),
+    'argon2id': Argon2Backend(),
+}
+
+
+def register_backend(backend):
+    '''Registers `backend` as the verifier of hashes with any of its
+    `idents`, making it available to `BCRYPT_BACKEND`::
+
+        register_backend(ScryptBackend())
+        app.config['BCRYPT_BACKEND'] = ScryptBackend(n=2 ** 15)
+
+    As hashes carry their parameters, the registered instance verifies
+    hashes made by any instance of the same class. It must stay registered
+    as long as such hashes exist.
+
+    :param backend: The :class:`KDFBackend` instance.
+    '''
+    if not isinstance(backend, KDFBackend) or not backend.idents:
+        raise ValueError('Invalid backend {0!r}.'.format(backend))
+    for ident in backend.idents:
+        if (not ident or '$' in ident or not ident.isascii() or
+                ident in ('2a', '2b', '2y', 'fbp', 'fbw')):
+            raise ValueError('Invalid backend ident {0!r}.'.format(ident))
+    for ident in backend.idents:
+        _KDF_BACKENDS[ident] = backend
+
+
+class SaltPool(object):
+    '''Pregenerated bcrypt salts, kept per cost and prefix, so that
+    generating a hash does not wait for the system's random number
+    generator. Once a pool runs half empty, a background thread refills it
+    to `size` salts. Each salt is handed out once; an empty pool falls back
+    to generating a salt on the spot.
+
+    :param size: The number of salts kept per cost and prefix.
+    '''
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('size must be at least 1.')
+        self.size = size
+        self.clear()
+
+    def take(self, rounds, prefix):
+        '''Returns a salt for `rounds` and `prefix` that has not been handed
+        out before.
+
+        :param rounds: The number of rounds.
+        :param prefix: The algorithm version as bytes.'''
+        salts = self._salts.get((rounds, prefix))
+        if salts is None:
+            salts = self._salts.setdefault((rounds, prefix), deque())
+        try:
+            salt = salts.popleft()
+        except IndexError:
+            salt = None
+        if len(salts) <= self.size // 2:
+            self._refill_later()
+        if salt is None:
+            salt = _bcrypt().gensalt(rounds=rounds, prefix=prefix)
+        return salt
+
+    def fill(self, rounds, prefix):
+        '''Fills the pool for `rounds` and `prefix` on the calling thread.
+
+        :param rounds: The number of rounds.
+        :param prefix: The algorithm version as bytes.'''
+        salts = self._salts.setdefault((rounds, prefix), deque())
+        gensalt = _bcrypt().gensalt
+        while len(salts) < self.size:
+            salts.append(gensalt(rounds=rounds, prefix=prefix))
+
+    def clear(self):
+        '''Discards all salts and forgets the refilling thread, as needed in
+        a forked child.'''
+        wanted = getattr(self, '_wanted', None)
+        self._salts = {}
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._thread = None
+        if wanted is not None:
+            # Lets a refilling thread of this process see it is obsolete.
+            wanted.set()
+
+    def _refill_later(self):
+        self._wanted.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._refill, args=(self._wanted,),
+                        name='flask-bcrypt-salt-pool', daemon=True)
+                    self._thread.start()
+
+    def _refill(self, wanted):
+        while True:
+            wanted.wait()
+            wanted.clear()
+            if wanted is not self._wanted:
+                return
+            for rounds, prefix in list(self._salts):
+                self.fill(rounds, prefix)
+
+
+class _SlotWaiter(object):
+    '''A caller queued by a :class:`HashingLimiter`, woken by handing it a
+    slot. Threads wait on an event, coroutines on a future of their loop.'''
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.admitted = False
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def admit(self):
+        '''Hands the waiter a slot. Returns False if it cannot be woken
+        because its event loop is closed.'''
+        if self.loop is None:
+            self.admitted = True
+            self.event.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            return False
+        self.admitted = True
+        return True
+
+    def _wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class HashingLimiter(object):
+    '''Admission control for password hashing. At most `max_in_flight`
+    hashes are admitted at once and at most `max_queue` callers wait for a
+    slot, each for at most `queue_timeout` seconds. Callers beyond that are
+    rejected with :exc:`HashingSaturatedError`. Waiting callers are admitted
+    in order, whether they wait in a thread with :meth:`acquire` or in a
+    coroutine with :meth:`async_acquire`.
+
+    The current number of admitted and waiting callers and the total number
+    of rejections are available as `in_flight`, `queued` and `rejected`, or
+    together from :meth:`stats`.
+
+    :param max_in_flight: The maximum number of concurrent hashes.
+    :param max_queue: The maximum number of callers waiting for a slot.
+    :param queue_timeout: The maximum number of seconds to wait for a slot,
+                          or None to wait indefinitely.
+    '''
+
+    def __init__(self, max_in_flight, max_queue=0, queue_timeout=None):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1.')
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def _enqueue(self, loop=None):
+        '''Takes a free slot and returns None, or queues and returns a
+        :class:`_SlotWaiter`, or raises :exc:`HashingSaturatedError` if the
+        queue is full. Must be called with the lock held.'''
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return None
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HashingSaturatedError('Too many password hashes in '
+                                        'progress.')
+        waiter = _SlotWaiter(loop)
+        self._waiters.append(waiter)
+        self.queued += 1
+        return waiter
+
+    def _give_up(self, waiter):
+        '''Removes `waiter` from the queue after its wait ended without a
+        slot. Returns False if it was handed a slot in the meantime.'''
+        with self._lock:
+            if waiter.admitted:
+                return False
+            self._waiters.remove(waiter)
+            self.queued -= 1
+            return True
+
+    def _timeout(self, timeout):
+        timeouts = [t for t in (timeout, self.queue_timeout)
+                    if t is not None]
+        return max(0, min(timeouts)) if timeouts else None
+
+    def _timed_out(self):
+        with self._lock:
+            self.rejected += 1
+        return HashingSaturatedError('Timed out waiting to hash a password.')
+
+    def acquire(self, timeout=None):
+        '''Waits for a slot, raising :exc:`HashingSaturatedError` if the
+        queue is full or the wait times out.
+
+        :param timeout: An optional limit in seconds on the wait, applied in
+                        addition to `queue_timeout`.'''
+        with self._lock:
+            waiter = self._enqueue()
+        if waiter is None:
+            return
+        waiter.event.wait(self._timeout(timeout))
+        if self._give_up(waiter):
+            raise self._timed_out()
+
+    async def async_acquire(self, timeout=None):
+        '''The awaitable counterpart of :meth:`acquire`, which waits
+        without occupying a thread. A caller cancelled while waiting leaves
+        the queue, or gives back the slot it was handed.
+
+        :param timeout: An optional limit in seconds on the wait, applied in
+                        addition to `queue_timeout`.'''
+        import asyncio
+        with self._lock:
+            waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.future, self._timeout(timeout))
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                raise self._timed_out()
+        except BaseException:
+            if not self._give_up(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        '''Gives back a slot obtained from :meth:`acquire`, handing it to
+        the longest waiting caller, if any.'''
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                self.queued -= 1
+                if waiter.admit():
+                    return
+            self.in_flight -= 1
+
+    def stats(self):
+        '''Returns the current counters as a dict.'''
+        with self._lock:
+            return {'in_flight': self.in_flight, 'queued': self.queued,
+                    'rejected': self.rejected}
+
+
+class HashingMetrics(object):
+    '''Pull-style metrics of the hashes computed by a :class:`Bcrypt`
+    instance: latency histograms by operation, cost and prefix, histograms
+    of the time spent waiting for the limiter by operation, and counters of
+    verification results (`check_success`, `check_failure`), verification
+    cache hits (`cache_hit`), rehashes (`rehash`), limiter rejections
+    (`rejected`), hashes refused by a request budget (`budget_exceeded`)
+    and verifications refused by the rate limiter (`rate_limited`).
+
+    :param buckets: The upper bounds, in seconds, of the histogram buckets.
+    '''
+
+    #: The default upper bounds of the histogram buckets, in seconds.
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._latency = {}
+        self._wait = {}
+        self._counters = dict.fromkeys(
+            ('check_success', 'check_failure', 'cache_hit', 'rehash',
+             'rejected', 'budget_exceeded', 'rate_limited'), 0)
+        self._lock = threading.Lock()
+
+    def _add(self, histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            # One count per bucket plus one for values beyond the last.
+            histogram = histograms[key] = {
+                'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0,
+                'count': 0}
+        histogram['counts'][bisect.bisect_left(self.buckets, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def observe(self, operation, cost, prefix, duration, wait=0.0):
+        '''Records a hash.
+
+        :param operation: Either `'generate'` or `'check'`.
+        :param cost: The log rounds of the hash.
+        :param prefix: The algorithm version of the hash.
+        :param duration: The seconds spent hashing.
+        :param wait: The seconds spent waiting for admission.'''
+        with self._lock:
+            self._add(self._latency, (operation, cost, prefix), duration)
+            self._add(self._wait, operation, wait)
+
+    def increment(self, counter, amount=1):
+        '''Increments one of the counters.
+
+        :param counter: The name of the counter.
+        :param amount: The amount to add.'''
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def _histogram_snapshot(self, histogram):
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                histogram['counts']):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': histogram['sum'],
+                'count': histogram['count']}
+
+    def snapshot(self):
+        '''Returns the current metrics as a dict with the keys `latency`,
+        `wait` and `counters`. Latency histograms are listed with their
+        `operation`, `cost` and `prefix`, wait histograms with their
+        `operation`; each has cumulative `buckets` of `(upper_bound, count)`
+        tuples, a `sum` and a `count`.'''
+        with self._lock:
+            latency = []
+            for (operation, cost, prefix), histogram in sorted(
+                    self._latency.items(), key=lambda item: str(item[0])):
+                entry = self._histogram_snapshot(histogram)
+                entry.update(operation=operation, cost=cost, prefix=prefix)
+                latency.append(entry)
+            wait = []
+            for operation, histogram in sorted(self._wait.items()):
+                entry = self._histogram_snapshot(histogram)
+                entry.update(operation=operation)
+                wait.append(entry)
+            return {'latency': latency, 'wait': wait,
+                    'counters': dict(self._counters)}
+
+    def reset(self):
+        '''Discards all recorded metrics.'''
+        with self._lock:
+            self._latency.clear()
+            self._wait.clear()
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+    def prometheus(self, namespace='flask_bcrypt'):
+        '''Renders the metrics in the Prometheus text exposition format,
+        suitable for serving from a `/metrics` view.
+
+        :param namespace: The prefix of the metric names.'''
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram(name, help_text, entries, label_names):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} histogram'.format(name))
+            for entry in entries:
+                labels = ','.join('{0}="{1}"'.format(label, entry[label])
+                                  for label in label_names)
+                for bound, count in entry['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        name, labels, le, count))
+                lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                    name, labels, entry['sum']))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    name, labels, entry['count']))
+
+        histogram(namespace + '_hash_duration_seconds',
+                  'Time spent computing password hashes.',
+                  snapshot['latency'], ('operation', 'cost', 'prefix'))
+        histogram(namespace + '_queue_wait_seconds',
+                  'Time spent waiting for admission to hash.',
+                  snapshot['wait'], ('operation',))
+        for counter, value in sorted(snapshot['counters'].items()):
+            name = '{0}_{1}_total'.format(namespace, counter)
+            lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class RateLimiter(object):
+    '''A token bucket rate limiter for password verification attempts.
+    Each identity may make `capacity` attempts in a burst, after which
+    attempts are refilled at `rate` per second.
+
+    :param capacity: The size of each bucket.
+    :param rate: The number of attempts refilled per second.
+    :param backend: The :class:`RateLimitBackend` holding the buckets,
+                    a :class:`MemoryRateLimitBackend` by default.
+    '''
+
+    def __init__(self, capacity, rate, backend=None):
+        if backend is None:
+            backend = MemoryRateLimitBackend()
+        self.capacity = capacity
+        self.rate = rate
+        self.backend = backend
+
+    def consume(self, identity):
+        '''Takes an attempt from the bucket of `identity`, or of each
+        identity if a list is given, raising :exc:`RateLimitExceededError`
+        if one of them is empty.
+
+        :param identity: A string or a list of strings.'''
+        identities = [identity] if isinstance(identity, str) else identity
+        for key in identities:
+            retry_after = self.backend.take(key, self.capacity, self.rate)
+            if retry_after > 0:
+                raise RateLimitExceededError(
+                    'Too many attempts for {0!r}.'.format(key), retry_after)
+
+
+class RateLimitBackend(object):
+    '''The interface of the storage behind a :class:`RateLimiter`.'''
+
+    def take(self, key, capacity, rate):
+        '''Takes a token from the bucket of `key`, first refilling it at
+        `rate` tokens per second up to `capacity`. Returns 0 if a token was
+        taken, otherwise the number of seconds until one is available.'''
+        raise NotImplementedError
+
+    @staticmethod
+    def _refill(tokens, updated, now, capacity, rate):
+        '''Returns the refilled bucket state after taking a token, and the
+        seconds to wait if there was none.'''
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return tokens, (1 - tokens) / rate
+        return tokens - 1, 0
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    '''An in-process backend holding at most `max_keys` buckets, evicting
+    the least recently used ones. An evicted identity starts over with a
+    full bucket, so `max_keys` should comfortably exceed the number of
+    identities active within a refill period.
+
+    :param max_keys: The maximum number of buckets.
+    '''
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = self._refill(tokens, updated, now,
+                                               capacity, rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class KeyValueRateLimitBackend(RateLimitBackend):
+    '''A backend for a shared key-value store, for deployments spanning
+    several processes or hosts. `client` must provide `eval(script,
+    numkeys, *keys_and_args)` running a Lua script atomically, as a
+    :class:`redis.Redis` client does, so concurrent attempts for the same
+    identity from several workers are counted exactly. Keys are sha256
+    digests of the identities.
+
+    :param client: The key-value store client.
+    :param prefix: The namespace for keys within the store.
+    '''
+
+    #: Takes a token from the bucket in KEYS[1], given the capacity, rate
+    #: and current time in ARGV, and returns the seconds to wait if there
+    #: was none. A bucket that would be full again can simply expire.
+    script = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens, updated = capacity, now
+local value = redis.call('GET', KEYS[1])
+if value then
+    local sep = string.find(value, ':', 1, true)
+    if sep then
+        tokens = tonumber(string.sub(value, 1, sep - 1)) or capacity
+        updated = tonumber(string.sub(value, sep + 1)) or now
+    end
+end
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local retry_after = 0
+if tokens < 1 then
+    retry_after = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+local ttl = math.max(1, math.floor((capacity - tokens) / rate) + 1)
+redis.call('SET', KEYS[1], string.format('%.17g:%.17g', tokens, now),
+           'EX', ttl)
+return tostring(retry_after)
+'''
+
+    def __init__(self, client, prefix='flask-bcrypt-ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, capacity, rate):
+        name = self.prefix + hashlib.sha256(key.encode('utf-8')).hexdigest()
+        # Numbers returned by Lua are truncated to integers, hence the
+        # string.
+        return float(self.client.eval(self.script, 1, name, repr(capacity),
+                                      repr(rate), repr(time.time())))
+
+
+class VerificationCache(object):
+    '''A cache of successful password verifications.
+
+    Each entry is keyed by an HMAC of the password hash and holds an HMAC of
+    the hash together with the password, so neither the plaintext nor
+    anything that could be checked against it offline without `key` is
+    stored. As a consequence there is at most one entry per hash, and
+    replacing a hash leaves the old entry unreachable. Entries expire after
+    `ttl` seconds.
+
+    The entries themselves live in `backend`, which defaults to a
+    :class:`MemoryCacheBackend` of `max_entries` entries. Workers sharing a
+    backend must also share `key`.
+
+    :param key: The secret HMAC key.
+    :param max_entries: The maximum number of cached verifications of the
+                        default backend.
+    :param ttl: The number of seconds a verification is remembered.
+    :param backend: The :class:`CacheBackend` storing the entries.
+    '''
+
+    def __init__(self, key, max_entries=1024, ttl=300, backend=None):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if backend is None:
+            backend = MemoryCacheBackend(max_entries)
+        self.key = key
+        self.ttl = ttl
+        self.backend = backend
+
+    def _slot(self, pw_hash):
+        return hmac.new(self.key, pw_hash, hashlib.sha256).hexdigest()
+
+    def _token(self, pw_hash, password):
+        # The length prefix keeps (hash, password) pairs unambiguous.
+        message = str(len(pw_hash)).encode('ascii') + b':' + pw_hash + password
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def get(self, pw_hash, password):
+        '''Tells whether `password` was recently verified against `pw_hash`.
+
+        :param pw_hash: The hash as bytes.
+        :param password: The prepared password as bytes.'''
+        token = self.backend.get(self._slot(pw_hash))
+        if token is None:
+            return False
+        return hmac.compare_digest(token, self._token(pw_hash, password))
+
+    def add(self, pw_hash, password):
+        '''Remembers that `password` successfully verified against
+        `pw_hash`.
+
+        :param pw_hash: The hash as bytes.
+        :param password: The prepared password as bytes.'''
+        self.backend.set(self._slot(pw_hash), self._token(pw_hash, password),
+                         self.ttl)
+
+    def invalidate(self, pw_hash):
+        '''Forgets the verification of `pw_hash`, if any.
+
+        :param pw_hash: The hash as bytes.'''
+        self.backend.delete(self._slot(pw_hash))
+
+    def clear(self):
+        '''Forgets all verifications.'''
+        self.backend.clear()
+
+
+class CacheBackend(object):
+    '''The interface of the storage behind a :class:`VerificationCache`.
+    Keys are hex strings and values are short byte strings, both derived
+    with HMAC, so a backend never sees passwords or hashes.
+    '''
+
+    def get(self, key):
+        '''Returns the value stored under `key`, or None if it is missing
+        or expired.'''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''Stores `value` under `key` for `ttl` seconds.'''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''Removes `key`, if present.'''
+        raise NotImplementedError
+
+    def clear(self):
+        '''Removes all keys.'''
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    '''An in-process backend evicting the least recently used entries once
+    there are more than `max_entries`.
+
+    :param max_entries: The maximum number of entries.
+    '''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileCacheBackend(CacheBackend):
+    '''A backend shared by all workers on one host, storing each entry as a
+    small file in `directory`, ideally on a memory-backed file system such
+    as `/dev/shm`. Files are replaced atomically, and expired ones are
+    removed when read or by :meth:`prune`. A write that takes the number of
+    entries beyond `max_entries` prunes expired entries and then the oldest
+    ones.
+
+    As the entries let anyone able to write them skip verification, the
+    directory must belong to the current user and be inaccessible to
+    others; a directory created beforehand by another user is refused.
+
+    :param directory: The directory holding the entries. It is created if
+                      it does not exist.
+    :param max_entries: The maximum number of entries kept.
+    :raises ValueError: If `directory` is not a private directory of the
+                        current user.
+    '''
+
+    def __init__(self, directory, max_entries=1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o077 or
+                (hasattr(os, 'getuid') and info.st_uid != os.getuid())):
+            raise ValueError(
+                'The cache directory {0!r} must be a directory owned by the '
+                'current user and inaccessible to others.'.format(directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _read(self, path):
+        '''Returns the value stored at `path`, removing it if expired.'''
+        try:
+            with open(path, 'rb') as f:
+                expires, _, value = f.read().partition(b':')
+            if float(expires) > time.time():
+                return value
+            os.remove(path)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def set(self, key, value, ttl):
+        expires = repr(time.time() + ttl).encode('ascii')
+        with tempfile.NamedTemporaryFile('wb', dir=self.directory,
+                                         prefix='.', delete=False) as f:
+            f.write(expires + b':' + value)
+        os.replace(f.name, self._path(key))
+        # Only writes after a full hash get here, next to which listing the
+        # directory is cheap.
+        if len(os.listdir(self.directory)) > self.max_entries:
+            self._trim()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self.delete(name)
+
+    def prune(self):
+        '''Removes all expired entries.'''
+        for name in os.listdir(self.directory):
+            if not name.startswith('.'):
+                self._read(self._path(name))
+
+    def _trim(self):
+        '''Removes expired entries, then the least recently written ones
+        beyond `max_entries`.'''
+        self.prune()
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                entries.append((os.stat(self._path(name)).st_mtime_ns, name))
+            except OSError:
+                pass
+        entries.sort()
+        for _, name in entries[:max(0, len(entries) - self.max_entries)]:
+            self.delete(name)
+
+
+class KeyValueCacheBackend(CacheBackend):
+    '''A backend for a shared key-value store, for deployments spanning
+    several hosts. `client` must provide `get(name)`, `set(name, value,
+    ex=seconds)` and `delete(name)` as a :class:`redis.Redis` client does;
+    :meth:`clear` additionally uses `scan_iter(match=pattern)`. Expiry is
+    left to the store.
+
+    :param client: The key-value store client.
+    :param prefix: The namespace for keys within the store.
+    '''
+
+    def __init__(self, client, prefix='flask-bcrypt:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for name in list(self.client.scan_iter(match=self.prefix + '*')):
+            self.client.delete(name)
+
+
+def _classify_hash(pw_hash):
+    '''Returns the label under which `pw_hash` is counted by
+    :func:`scan_hashes`.'''
+    if isinstance(pw_hash, str):
+        pw_hash = pw_hash.encode('utf-8')
+    if pw_hash.startswith(_WERKZEUG_PREFIXES):
+        return pw_hash.split(b'$', 1)[0].decode('ascii', 'replace')
+    wrapped = pw_hash.startswith(_WRAPPED_PREFIX)
+    if wrapped:
+        method, _, tail = pw_hash[len(_WRAPPED_PREFIX):].partition(b'$')
+        pw_hash = b'$' + tail.partition(b'$')[2]
+    prehash, pw_hash = _split_prehash(pw_hash)
+    backend = _kdf_backend(pw_hash)
+    if backend is not None:
+        ident, cost = backend.settings(pw_hash)
+        if ident is None:
+            return 'malformed'
+        label = '${0}${1}'.format(ident, cost)
+    else:
+        try:
+            parsed = PasswordHash(pw_hash)
+        except (ValueError, TypeError, UnicodeError):
+            return 'malformed'
+        label = '${0}${1:02d}'.format(parsed.prefix, parsed.cost)
+    if wrapped:
+        label += ' wrapping {0}'.format(method.decode('ascii', 'replace'))
+    if prehash is not None:
+        label += ' prehashed with {0}'.format(prehash)
+    return label
+
+
+def _scan_chunk(chunk):
+    '''Counts the labels of a chunk of hashes. Module level so that it can
+    be sent to a process pool.'''
+    return Counter(_classify_hash(pw_hash) for pw_hash in chunk)
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def scan_hashes(hashes, chunk_size=10000, jobs=1):
+    '''Counts stored hashes by prefix and cost without hashing anything.
+    Returns a :class:`collections.Counter` mapping labels such as `'$2b$12'`
+    to the number of hashes, with unparsable hashes counted under
+    `'malformed'`.
+
+    `hashes` is consumed in chunks of `chunk_size`, and with more than one
+    job the chunks are parsed in a pool of processes. Only a few chunks per
+    job are held at a time, so memory use does not depend on the number of
+    hashes::
+
+        with open('hashes.txt', 'rb') as f:
+            report = scan_hashes((line.strip() for line in f), jobs=8)
+
+    :param hashes: An iterable of hashes as unicode strings or bytes.
+    :param chunk_size: The number of hashes parsed per task.
+    :param jobs: The number of processes to parse with.
+    '''
+    report = Counter()
+    chunks = _chunked(hashes, chunk_size)
+    if jobs <= 1:
+        for chunk in chunks:
+            report.update(_scan_chunk(chunk))
+        return report
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= 2 * jobs:
+                report.update(pending.popleft().result())
+            pending.append(executor.submit(_scan_chunk, chunk))
+        while pending:
+            report.update(pending.popleft().result())
+    return report
+
+
+def _query_hashes(uri, sql, chunk_size):
+    '''Streams the first column of the rows returned by `sql`.'''
+    import sqlalchemy
+
+    engine = sqlalchemy.create_engine(uri)
+    try:
+        with engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True).execute(sqlalchemy.text(sql))
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+    finally:
+        engine.dispose()
+
+
+cli = AppGroup('bcrypt', help='Flask-Bcrypt maintenance commands.')
+
+
+@cli.command('scan')
+@click.argument('source', type=click.File('rb'), default='-')
+@click.option('--sql', help='A query whose first column holds the hashes, '
+              'read instead of SOURCE.')
+@click.option('--database-uri', help='The SQLAlchemy database URI for --sql. '
+              'Defaults to SQLALCHEMY_DATABASE_URI.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='The number of hashes parsed per task.')
+@click.option('--jobs', '-j', default=os.cpu_count() or 1, show_default=True,
+              help='The number of processes to parse with.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print the report as JSON.')
+def scan_command(source, sql, database_uri, chunk_size, jobs, as_json):
+    '''Report the prefix and cost of stored hashes.
+
+    Hashes are read one per line from SOURCE, a file or - for stdin, or from
+    the result of --sql. No hashing takes place.
+    '''
+    if sql is not None:
+        uri = database_uri or current_app.config.get('SQLALCHEMY_DATABASE_URI')
+        if not uri:
+            raise click.UsageError('--sql requires --database-uri or '
+                                   'SQLALCHEMY_DATABASE_URI.')
+        hashes = _query_hashes(uri, sql, chunk_size)
+    else:
+        hashes = (line.strip() for line in source if line.strip())
+
+    report = scan_hashes(hashes, chunk_size=chunk_size, jobs=jobs)
+    total = sum(report.values())
+    if as_json:
+        click.echo(json.dumps({'total': total, 'hashes': dict(report)},
+                              sort_keys=True))
+        return
+
+    click.echo('Scanned {0} hashes'.format(total))
+    for label, count in sorted(report.items()):
+        click.echo('{0:<12} {1:>12} {2:>7.1%}'.format(label, count,
+                                                     count / total))
+
+
+class LegacyHashMigration(object):
+    '''A resumable job wrapping werkzeug hashes in bcrypt with
+    :meth:`Bcrypt.wrap_legacy_hash`, so that a whole table is upgraded without
+    waiting for every user to log in.
+
+    `rows` yields `(key, pw_hash)` tuples in a stable order, and `save` is
+    called as `save(key, new_hash)` from the thread calling :meth:`run` for
+    each upgraded hash. Rows are processed in batches of `batch_size` hashed
+    by `workers` threads, one by default, which use the extension's executor
+    but not its limiter, so that the migration neither takes the slots live
+    logins need nor fails when they are all taken. Raise `workers` only
+    where the cores are not needed for live traffic. After each batch the
+    number of rows processed is written to `checkpoint_file`, and a later
+    run with the same file skips them. Hashes that are not werkzeug hashes,
+    including already wrapped ones, are left alone. `max_per_second` caps
+    the rate of rows processed so that the migration does not starve live
+    traffic::
+
+        def save(user_id, new_hash):
+            User.query.get(user_id).pw_hash = new_hash.decode('utf-8')
+
+        rows = db.session.query(User.id, User.pw_hash).order_by(User.id)
+        migration = LegacyHashMigration(bcrypt, rows, save,
+                                        checkpoint_file='migration.json',
+                                        on_batch=db.session.commit)
+        migration.run()
+
+    :param bcrypt: The :class:`Bcrypt` instance.
+    :param rows: An iterable of `(key, pw_hash)` tuples.
+    :param save: Called with the key and new hash of each upgraded row.
+    :param checkpoint_file: An optional path recording progress.
+    :param batch_size: The number of rows per batch.
+    :param workers: The number of hashing threads.
+    :param max_per_second: An optional cap on the rows processed per second.
+    :param on_batch: An optional callable invoked after each batch is saved
+                     and before the checkpoint is written.
+    '''
+
+    def __init__(self, bcrypt, rows, save, checkpoint_file=None,
+                 batch_size=100, workers=1, max_per_second=None,
+                 on_batch=None):
+        self.bcrypt = bcrypt
+        self.rows = rows
+        self.save = save
+        self.checkpoint_file = checkpoint_file
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_per_second = max_per_second
+        self.on_batch = on_batch
+        self.position = self._load_checkpoint()
+        self.stats = {'migrated': 0, 'skipped': 0, 'failed': 0}
+
+    def _load_checkpoint(self):
+        if self.checkpoint_file is None:
+            return 0
+        try:
+            with open(self.checkpoint_file) as f:
+                return json.load(f)['position']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def _save_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_file))
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         delete=False) as f:
+            json.dump({'position': self.position, 'stats': self.stats}, f)
+        os.replace(f.name, self.checkpoint_file)
+
+    def _wrap(self, pw_hash):
+        try:
+            return self.bcrypt._wrap_legacy_hash(pw_hash, limited=False)
+        except ValueError:
+            return None
+
+    def run(self):
+        '''Runs the migration from the last checkpoint to the end of `rows`
+        and returns the counts of `migrated`, `skipped` and `failed` rows.
+        Failed rows are werkzeug hashes whose method cannot be recomputed.'''
+        rows = itertools.islice(self.rows, self.position, None)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch in _chunked(rows, self.batch_size):
+                started = time.monotonic()
+                self._run_batch(executor, batch)
+                if self.on_batch is not None:
+                    self.on_batch()
+                self.position += len(batch)
+                self._save_checkpoint()
+                if self.max_per_second:
+                    remaining = (len(batch) / self.max_per_second -
+                                 (time.monotonic() - started))
+                    if remaining > 0:
+                        time.sleep(remaining)
+        return dict(self.stats)
 
-        return hmac.compare_digest(bcrypt.hashpw(password, pw_hash), pw_hash)
+    def _run_batch(self, executor, batch):
+        legacy = []
+        for key, pw_hash in batch:
+            pw_hash = self.bcrypt._hash_to_bytes(pw_hash)
+            if pw_hash.startswith(_WERKZEUG_PREFIXES):
+                legacy.append((key, pw_hash))
+            else:
+                self.stats['skipped'] += 1
+        new_hashes = executor.map(self._wrap,
+                                  [pw_hash for _, pw_hash in legacy])
+        for (key, _), new_hash in zip(legacy, new_hashes):
+            if new_hash is None:
+                self.stats['failed'] += 1
+            else:
+                self.save(key, new_hash)
+                self.stats['migrated'] += 1
@@ -0,0 +1,282 @@
+'''
+    loadtest_bcrypt
+    ---------------
+
+    A load generator reproducing login storms against a sample Flask app
+    using Flask-Bcrypt.
+
+    The app is served by Werkzeug on a background thread and driven over
+    HTTP at a fixed rate with a weighted mix of signups, successful and
+    failed logins and non-auth requests. Latency is measured from the time a
+    request was scheduled, so that queueing in an overloaded server is not
+    hidden. The report gives the throughput and latency percentiles of each
+    endpoint, of auth and non-auth requests, and the CPU utilization of the
+    process, to show how hashing interferes with the rest of the app under
+    different executor and limit settings::
+
+        $ python loadtest_bcrypt.py --rate 40 --duration 20 --rounds 10
+        $ python loadtest_bcrypt.py --rate 40 --duration 20 --rounds 10 \\
+            --executor thread --max-workers 2 --max-concurrency 2
+
+    The client runs in the same process as the server, so the CPU figures
+    include its share, and those of process pool workers are not counted.
+
+    :copyright: (c) 2011 by Max Countryman.
+    :license: BSD, see LICENSE for more details.
+'''
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+from werkzeug.serving import make_server
+
+import flask_bcrypt
+from bench_bcrypt import percentile
+
+PASSWORD = 'correct horse battery staple'
+
+ENDPOINTS = {
+    'signup': ('/signup', True),
+    'login': ('/login', True),
+    'login_failure': ('/login', True),
+    'ping': ('/ping', False),
+}
+
+
+def make_app(options):
+    '''Returns the sample app, with `options.users` users signed up.'''
+    app = flask.Flask(__name__)
+    app.config['BCRYPT_LOG_ROUNDS'] = options.rounds
+    if options.executor != 'inline':
+        app.config['BCRYPT_EXECUTOR'] = options.executor
+        app.config['BCRYPT_MAX_WORKERS'] = options.max_workers
+    if options.max_concurrency is not None:
+        app.config['BCRYPT_MAX_CONCURRENCY'] = options.max_concurrency
+        app.config['BCRYPT_MAX_QUEUE'] = options.max_queue
+        app.config['BCRYPT_QUEUE_TIMEOUT'] = options.queue_timeout
+    bcrypt = flask_bcrypt.Bcrypt(app)
+    users = {}
+    lock = threading.Lock()
+    for name in range(options.users):
+        users[str(name)] = bcrypt.generate_password_hash(PASSWORD)
+
+    @app.errorhandler(flask_bcrypt.HashingSaturatedError)
+    def saturated(e):
+        return 'Try again later', 503
+
+    @app.route('/signup', methods=['POST'])
+    def signup():
+        pw_hash = bcrypt.generate_password_hash(flask.request.form['password'])
+        with lock:
+            users['user-{0}'.format(len(users))] = pw_hash
+        return 'created', 201
+
+    @app.route('/login', methods=['POST'])
+    def login():
+        pw_hash = users.get(flask.request.form['name'])
+        if pw_hash is None:
+            return 'unknown', 404
+        if bcrypt.check_password_hash(pw_hash, flask.request.form['password']):
+            return 'ok'
+        return 'denied', 401
+
+    @app.route('/ping')
+    def ping():
+        return flask.jsonify(users=len(users))
+
+    app.bcrypt = bcrypt
+    return app
+
+
+def parse_mix(value):
+    '''Parses weights like `'signup=1,login=4,login_failure=1,ping=10'`.'''
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(
+                'unknown request kind {0!r}, expected one of {1}'.format(
+                    name, ', '.join(sorted(ENDPOINTS))))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def send(base_url, kind, users, rng):
+    '''Sends one request of `kind` and returns its status code.'''
+    path, _ = ENDPOINTS[kind]
+    data = None
+    if kind == 'signup':
+        data = {'password': PASSWORD}
+    elif kind in ('login', 'login_failure'):
+        data = {'name': str(rng.randrange(users)),
+                'password': PASSWORD if kind == 'login' else 'wrong'}
+    if data is not None:
+        data = urllib.parse.urlencode(data).encode('ascii')
+    try:
+        with urllib.request.urlopen(base_url + path, data=data,
+                                    timeout=60) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def drive(base_url, options):
+    '''Sends requests at `options.rate` per second for `options.duration`
+    seconds and returns `(kind, status, latency)` tuples.'''
+    rng = random.Random(options.seed)
+    kinds = sorted(options.mix)
+    weights = [options.mix[kind] for kind in kinds]
+    results = []
+    lock = threading.Lock()
+
+    def request(kind, scheduled):
+        status = send(base_url, kind, options.users,
+                      random.Random(rng.random()))
+        latency = time.perf_counter() - scheduled
+        with lock:
+            results.append((kind, status, latency))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(options.clients) as pool:
+        for i in itertools.count():
+            scheduled = start + i / options.rate
+            if scheduled - start >= options.duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            pool.submit(request, kind, scheduled)
+    return results
+
+
+def summarize(results, elapsed):
+    '''Returns the count, throughput, errors and latency percentiles, in
+    milliseconds, of `(kind, status, latency)` results.'''
+    latencies = sorted(latency for _, _, latency in results)
+    summary = {
+        'n': len(results),
+        'per_sec': len(results) / elapsed,
+        'errors': sum(1 for _, status, _ in results if status >= 500),
+    }
+    if latencies:
+        summary.update({
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        })
+    return summary
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(options):
+    # Werkzeug logs every request, which would drown the report.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = make_app(options)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+    try:
+        start, cpu_start = time.perf_counter(), cpu_seconds()
+        results = drive(base_url, options)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds() - cpu_start
+    finally:
+        server.shutdown()
+        app.bcrypt.shutdown_executor()
+
+    groups = {'auth': [], 'non_auth': []}
+    endpoints = {}
+    for result in results:
+        endpoints.setdefault(result[0], []).append(result)
+        groups['auth' if ENDPOINTS[result[0]][1] else 'non_auth'].append(
+            result)
+    return {
+        'options': {k: v for k, v in vars(options).items()
+                    if k not in ('output',)},
+        'elapsed_s': elapsed,
+        'cpu_utilization': cpu / elapsed / (os.cpu_count() or 1),
+        'statuses': {str(status): count for status, count in sorted(
+            Counter(status for _, status, _ in results).items())},
+        'groups': {name: summarize(group, elapsed)
+                   for name, group in groups.items()},
+        'endpoints': {name: summarize(group, elapsed)
+                      for name, group in sorted(endpoints.items())},
+    }
+
+
+def print_report(report):
+    rows = [(name, report['groups'][name])
+            for name in ('auth', 'non_auth')]
+    rows += sorted(report['endpoints'].items())
+    for name, summary in rows:
+        print('{0:<14} {1:7d} req {2:8.1f} req/s {3:5d} errors  '
+              'p50 {4:8.1f} ms  p95 {5:8.1f} ms  p99 {6:8.1f} ms'.format(
+                  name, summary['n'], summary['per_sec'], summary['errors'],
+                  summary.get('p50_ms', 0), summary.get('p95_ms', 0),
+                  summary.get('p99_ms', 0)))
+    print('statuses {0}'.format(report['statuses']))
+    print('cpu utilization {0:.1%} of {1} cores over {2:.1f} s'.format(
+        report['cpu_utilization'], os.cpu_count(), report['elapsed_s']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Drive login storms against a Flask app using '
+                    'Flask-Bcrypt.')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests sent per second')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to send requests for')
+    parser.add_argument('--mix', type=parse_mix,
+                        default='signup=1,login=4,login_failure=1,ping=10',
+                        help='weights of the request kinds')
+    parser.add_argument('--clients', type=int, default=64,
+                        help='maximum number of requests in flight')
+    parser.add_argument('--users', type=int, default=10,
+                        help='users signed up before the run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--executor', default='inline',
+                        choices=['inline', 'thread', 'process'])
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--max-concurrency', type=int,
+                        help='admission limit of concurrent hashes')
+    parser.add_argument('--max-queue', type=int, default=0)
+    parser.add_argument('--queue-timeout', type=float)
+    parser.add_argument('--output', help='write the report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = run(options)
+    print_report(report)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,7 +24,8 @@ setup(
     py_modules=['flask_bcrypt'],
     zip_safe=False,
     platforms='any',
-    install_requires=['Flask', 'bcrypt>=3.1.1'],
+    install_requires=['Flask', 'bcrypt>=3.1.1', 'blinker'],
+    extras_require={'argon2': ['argon2-cffi']},
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
@@ -1,10 +1,52 @@
 # coding:utf-8
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 import flask
-from flask_bcrypt import (Bcrypt,
+import flask_bcrypt
+from werkzeug.security import generate_password_hash as werkzeug_hash
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+from flask_bcrypt import (Argon2Backend,
+                          Bcrypt,
+                          FileCacheBackend,
+                          HashingMetrics,
+                          HashingBudgetExceededError,
+                          HashingLimiter,
+                          HashingSaturatedError,
+                          HashingSpan,
+                          KDFBackend,
+                          KeyValueCacheBackend,
+                          KeyValueRateLimitBackend,
+                          LegacyHashMigration,
+                          MemoryRateLimitBackend,
+                          PasswordHash,
+                          PBKDF2Backend,
+                          RateLimitBackend,
+                          RateLimiter,
+                          RateLimitExceededError,
+                          SaltPool,
+                          VerificationCache,
+                          async_check_password_hash,
+                          async_generate_password_hash,
                           check_password_hash,
-                          generate_password_hash)
+                          generate_password_hash,
+                          hash_finished,
+                          hash_started,
+                          register_backend,
+                          register_prehash,
+                          scan_hashes)
 
 
 class BasicTestCase(unittest.TestCase):
@@ -84,5 +126,1558 @@ class LongPasswordsTestCase(BasicTestCase):
         self.assertFalse(self.bcrypt.check_password_hash(pw_hash, 'A' * 80))
 
 
+class AppSettingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bcrypt = Bcrypt()
+        self.app = flask.Flask(__name__)
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.app.config['BCRYPT_BLUEPRINTS'] = {
+            'admin': {'BCRYPT_LOG_ROUNDS': 6},
+            'admin.api': {'BCRYPT_HASH_PREFIX': '2a'},
+        }
+        self.other = flask.Flask(__name__)
+        self.other.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.other.config['BCRYPT_HANDLE_LONG_PASSWORDS'] = True
+        self.bcrypt.init_app(self.app)
+        self.bcrypt.init_app(self.other)
+
+    def cost(self, pw_hash):
+        return PasswordHash(pw_hash).cost
+
+    def test_per_app_settings(self):
+        with self.app.app_context():
+            pw_hash = self.bcrypt.generate_password_hash('secret')
+            self.assertEqual(self.cost(pw_hash), 5)
+            self.assertFalse(self.bcrypt.needs_rehash(pw_hash))
+        with self.other.app_context():
+            self.assertEqual(self.cost(
+                self.bcrypt.generate_password_hash('secret')), 4)
+            self.assertTrue(self.bcrypt.needs_rehash(pw_hash))
+            self.assertTrue(self.bcrypt._handle_long_passwords)
+        self.assertIsInstance(self.app.extensions['bcrypt'].settings, tuple)
+
+    def test_per_app_components(self):
+        first, second = flask.Flask(__name__), flask.Flask(__name__)
+        first.config.update(BCRYPT_LOG_ROUNDS=4, BCRYPT_CACHE_ENABLED=True,
+                            BCRYPT_MAX_CONCURRENCY=2, BCRYPT_EXECUTOR='thread',
+                            BCRYPT_REQUEST_MAX_OPERATIONS=1)
+        second.config.update(BCRYPT_LOG_ROUNDS=4, BCRYPT_MAX_CONCURRENCY=1,
+                             BCRYPT_RATE_LIMIT_CAPACITY=5)
+        bcrypt = Bcrypt()
+        bcrypt.init_app(first)
+        bcrypt.init_app(second)
+        self.addCleanup(bcrypt.shutdown_executor)
+
+        @first.route('/twice')
+        @second.route('/twice')
+        def twice():
+            try:
+                bcrypt.generate_password_hash('secret')
+                bcrypt.generate_password_hash('secret')
+            except HashingBudgetExceededError:
+                return 'busy', 503
+            return 'ok'
+
+        with first.app_context():
+            self.assertIsNotNone(bcrypt.verification_cache)
+            self.assertEqual(bcrypt.limiter.max_in_flight, 2)
+            self.assertIsNone(bcrypt.rate_limiter)
+            self.assertIsNotNone(bcrypt.get_executor())
+        with second.app_context():
+            self.assertIsNone(bcrypt.verification_cache)
+            self.assertEqual(bcrypt.limiter.max_in_flight, 1)
+            self.assertIsNotNone(bcrypt.rate_limiter)
+            self.assertIsNone(bcrypt.get_executor())
+        self.assertEqual(first.test_client().get('/twice').status_code, 503)
+        self.assertEqual(second.test_client().get('/twice').status_code, 200)
+
+    def test_other_instances_keep_their_settings(self):
+        with self.app.app_context():
+            self.assertEqual(self.cost(
+                flask_bcrypt.generate_password_hash('secret')), 12)
+            self.assertEqual(Bcrypt()._log_rounds, 12)
+        # in apps it was not initialized with, an instance falls back to
+        # the settings of the app it was initialized with last
+        other = Bcrypt(self.app)
+        with self.other.app_context():
+            self.assertEqual(other._log_rounds, 5)
+            self.assertEqual(self.bcrypt._log_rounds, 4)
+
+    def test_outside_app_context_uses_last_app(self):
+        self.assertEqual(self.bcrypt._log_rounds, 4)
+        self.assertTrue(self.bcrypt._handle_long_passwords)
+
+    def test_blueprint_overrides(self):
+        admin = flask.Blueprint('admin', __name__)
+        api = flask.Blueprint('api', __name__)
+
+        @admin.route('/hash')
+        @api.route('/hash')
+        def hash_view():
+            return self.bcrypt.generate_password_hash('secret')
+
+        @self.app.route('/hash')
+        def app_view():
+            return self.bcrypt.generate_password_hash('secret')
+
+        admin.register_blueprint(api, url_prefix='/api')
+        self.app.register_blueprint(admin, url_prefix='/admin')
+        client = self.app.test_client()
+
+        self.assertTrue(client.get('/hash').data.startswith(b'$2b$05$'))
+        self.assertTrue(
+            client.get('/admin/hash').data.startswith(b'$2b$06$'))
+        self.assertTrue(
+            client.get('/admin/api/hash').data.startswith(b'$2a$06$'))
+
+
+class PrehashTestCase(unittest.TestCase):
+
+    def make_bcrypt(self, **config):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config.update(config)
+        return Bcrypt(app)
+
+    def test_strategies(self):
+        for strategy in ('sha256-hex', 'sha256-b64', 'sha384-b64',
+                         'hmac-sha256-b64'):
+            bcrypt = self.make_bcrypt(BCRYPT_PREHASH=strategy,
+                                      BCRYPT_PEPPER='pepper')
+            pw_hash = bcrypt.generate_password_hash('A' * 1000)
+            self.assertTrue(pw_hash.startswith(
+                '$fbp${0}$2b$04$'.format(strategy).encode('ascii')))
+            self.assertTrue(bcrypt.check_password_hash(pw_hash, 'A' * 1000))
+            self.assertFalse(bcrypt.check_password_hash(pw_hash, 'A' * 999))
+            self.assertFalse(bcrypt.needs_rehash(pw_hash))
+
+    def test_mixed_population(self):
+        legacy = self.make_bcrypt(BCRYPT_HANDLE_LONG_PASSWORDS=True)
+        plain = self.make_bcrypt()
+        bcrypt = self.make_bcrypt(BCRYPT_HANDLE_LONG_PASSWORDS=True,
+                                  BCRYPT_PREHASH='sha256-b64')
+        old_hash = legacy.generate_password_hash('A' * 80)
+        new_hash = bcrypt.generate_password_hash('A' * 80)
+        self.assertTrue(bcrypt.check_password_hash(old_hash, 'A' * 80))
+        self.assertTrue(bcrypt.check_password_hash(new_hash, 'A' * 80))
+        # Marked hashes verify whatever the long password setting.
+        self.assertTrue(plain.check_password_hash(new_hash, 'A' * 80))
+        self.assertTrue(plain.needs_rehash(new_hash))
+
+        self.assertTrue(bcrypt.needs_rehash(old_hash))
+        valid, rehashed = bcrypt.check_and_rehash(old_hash, 'A' * 80)
+        self.assertTrue(valid)
+        self.assertTrue(rehashed.startswith(b'$fbp$sha256-b64$'))
+
+    def test_pepper(self):
+        bcrypt = self.make_bcrypt(BCRYPT_PREHASH='hmac-sha256-b64',
+                                  BCRYPT_PEPPER='pepper')
+        pw_hash = bcrypt.generate_password_hash('secret')
+        other = self.make_bcrypt(BCRYPT_PEPPER='other')
+        self.assertFalse(other.check_password_hash(pw_hash, 'secret'))
+        with self.assertRaises(ValueError):
+            self.make_bcrypt(BCRYPT_PREHASH='hmac-sha256-b64') \
+                .generate_password_hash('secret')
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            self.make_bcrypt(BCRYPT_PREHASH='md5')
+        bcrypt = self.make_bcrypt()
+        pw_hash = bcrypt.generate_password_hash('secret')
+        with self.assertRaises(ValueError):
+            bcrypt.check_password_hash(b'$fbp$md5' + pw_hash, 'secret')
+
+    def test_register_prehash(self):
+        register_prehash('reversed', lambda password, pepper: password[::-1])
+        self.addCleanup(flask_bcrypt._PREHASH_STRATEGIES.pop, 'reversed')
+        bcrypt = self.make_bcrypt(BCRYPT_PREHASH='reversed')
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(self.make_bcrypt().check_password_hash(pw_hash,
+                                                               'secret'))
+        with self.assertRaises(ValueError):
+            register_prehash('a$b', lambda password, pepper: password)
+
+    def test_parsed_and_scanned(self):
+        bcrypt = self.make_bcrypt(BCRYPT_PREHASH='sha256-b64')
+        raw = bcrypt.generate_password_hash('secret')
+        pw_hash = PasswordHash(raw)
+        self.assertEqual(pw_hash.prehash, 'sha256-b64')
+        self.assertEqual(pw_hash.cost, 4)
+        self.assertEqual(bytes(pw_hash.salt), raw[-53:-31])
+        self.assertEqual(bytes(pw_hash.digest), raw[-31:])
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+        self.assertEqual(scan_hashes([raw]),
+                         {'$2b$04 prehashed with sha256-b64': 1})
+
+
+class KDFBackendTestCase(unittest.TestCase):
+
+    def make_bcrypt(self, **config):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config.update(config)
+        return Bcrypt(app)
+
+    def test_pbkdf2(self):
+        bcrypt = self.make_bcrypt(
+            BCRYPT_BACKEND=PBKDF2Backend('sha512', iterations=1000))
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(pw_hash.startswith(b'$pbkdf2-sha512$1000$'))
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.check_password_hash(pw_hash, 'hunter2'))
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+        stronger = PBKDF2Backend('sha512', iterations=2000)
+        self.assertTrue(bcrypt.needs_rehash(
+            stronger.hashpw(b'secret', stronger.gensalt())))
+        self.assertEqual(bcrypt.metrics.snapshot()['latency'][0]['prefix'],
+                         'pbkdf2-sha512')
+
+    def test_register_backend(self):
+        class SHA256Backend(KDFBackend):
+            idents = ('test-sha256',)
+
+            def gensalt(self, rounds=None):
+                return b'$test-sha256$' + os.urandom(8).hex().encode('ascii')
+
+            def hashpw(self, password, salt):
+                parts = salt.split(b'$')[:3]
+                digest = hashlib.sha256(parts[2] + password).hexdigest()
+                return b'$'.join(parts + [digest.encode('ascii')])
+
+            def settings(self, pw_hash):
+                return 'test-sha256', None
+
+            def needs_rehash(self, pw_hash):
+                return not pw_hash.startswith(b'$test-sha256$')
+
+        with self.assertRaises(ValueError):
+            self.make_bcrypt(BCRYPT_BACKEND=SHA256Backend())
+        self.assertNotIn('test-sha256', flask_bcrypt._KDF_BACKENDS)
+        register_backend(SHA256Backend())
+        self.addCleanup(flask_bcrypt._KDF_BACKENDS.pop, 'test-sha256')
+        bcrypt = self.make_bcrypt(BCRYPT_BACKEND=SHA256Backend())
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(pw_hash.startswith(b'$test-sha256$'))
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.check_password_hash(pw_hash, 'hunter2'))
+        SHA256Backend.idents = ('2b',)
+        with self.assertRaises(ValueError):
+            register_backend(SHA256Backend())
+
+    def test_bcrypt_rounds_ignored(self):
+        # 12 bcrypt rounds must not become 12 PBKDF2 iterations
+        bcrypt = self.make_bcrypt(
+            BCRYPT_BACKEND=PBKDF2Backend(iterations=1000))
+        pw_hash = bcrypt.generate_password_hash('secret', 12, '2a')
+        self.assertTrue(pw_hash.startswith(b'$pbkdf2-sha256$1000$'))
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+
+    def test_parsed(self):
+        bcrypt = self.make_bcrypt(
+            BCRYPT_BACKEND=PBKDF2Backend(iterations=1000),
+            BCRYPT_PREHASH='sha256-b64')
+        parsed = bcrypt.generate_password_hash('secret', parsed=True)
+        self.assertIsInstance(parsed.backend, PBKDF2Backend)
+        self.assertEqual((parsed.prehash, parsed.prefix, parsed.cost),
+                         ('sha256-b64', 'pbkdf2-sha256', 1000))
+        salt, digest = bytes(parsed).rsplit(b'$', 2)[1:]
+        self.assertEqual((bytes(parsed.salt), bytes(parsed.digest)),
+                         (salt, digest))
+        self.assertEqual(repr(parsed),
+                         '<PasswordHash $pbkdf2-sha256$1000$...>')
+        self.assertTrue(bcrypt.check_password_hash(parsed, 'secret'))
+        self.assertFalse(bcrypt.needs_rehash(parsed))
+        self.assertTrue(bcrypt.needs_rehash(PasswordHash(
+            self.make_bcrypt().generate_password_hash('secret'))))
+        with self.assertRaises(ValueError):
+            PasswordHash('$pbkdf2-sha256$many$salt$digest')
+
+    def test_selected_per_hash(self):
+        pbkdf2 = self.make_bcrypt(
+            BCRYPT_BACKEND=PBKDF2Backend(iterations=1000))
+        bcrypt = self.make_bcrypt()
+        pw_hash = pbkdf2.generate_password_hash('secret')
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertTrue(bcrypt.needs_rehash(pw_hash))
+        self.assertTrue(pbkdf2.needs_rehash(
+            bcrypt.generate_password_hash('secret')))
+
+        valid, new_hash = bcrypt.check_and_rehash(pw_hash, 'secret')
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith(b'$2b$04$'))
+        self.assertEqual(scan_hashes([pw_hash, new_hash]),
+                         {'$pbkdf2-sha256$1000': 1, '$2b$04': 1})
+
+    def test_with_prehash_and_dummy_check(self):
+        bcrypt = self.make_bcrypt(
+            BCRYPT_BACKEND=PBKDF2Backend(iterations=1000),
+            BCRYPT_PREHASH='sha256-b64')
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(pw_hash.startswith(b'$fbp$sha256-b64$pbkdf2-'))
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+        self.assertFalse(bcrypt.dummy_check('secret'))
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            self.make_bcrypt(BCRYPT_BACKEND='scrypt')
+        with self.assertRaises(ValueError):
+            PBKDF2Backend('md5')
+
+    @unittest.skipIf(argon2 is None, 'argon2-cffi is not installed')
+    def test_argon2id(self):
+        bcrypt = self.make_bcrypt(BCRYPT_BACKEND=Argon2Backend(
+            time_cost=1, memory_cost=1024, parallelism=1))
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(pw_hash.startswith(b'$argon2id$v=19$m=1024,t=1,p=1$'))
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.check_password_hash(pw_hash, 'hunter2'))
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+        self.assertTrue(argon2.PasswordHasher().verify(pw_hash, 'secret'))
+
+
+class WarmupTestCase(unittest.TestCase):
+
+    def make_bcrypt(self, **config):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config.update(config)
+        bcrypt = Bcrypt(app)
+        self.addCleanup(bcrypt.shutdown_executor)
+        return bcrypt
+
+    def test_warmup_starts_executor(self):
+        bcrypt = self.make_bcrypt(BCRYPT_EXECUTOR='thread',
+                                  BCRYPT_MAX_WORKERS=2, BCRYPT_WARMUP=True)
+        self.assertIsNotNone(bcrypt._state().managed_executor)
+        self.assertEqual(len(bcrypt._state().managed_executor._threads), 2)
+        self.assertEqual(bcrypt.metrics.snapshot()['latency'], [])
+
+    def test_custom_executor_size(self):
+        # a custom executor need not have ThreadPoolExecutor's attributes
+        executor = mock.Mock(wraps=ThreadPoolExecutor(3))
+        self.addCleanup(executor.shutdown)
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_MAX_WORKERS'] = 3
+        bcrypt = Bcrypt(app, executor=executor)
+        bcrypt.warmup()
+        self.assertEqual(executor.submit.call_count, 3)
+        self.assertEqual(len(list(bcrypt.generate_password_hashes(
+            ['secret'] * 10))), 10)
+
+    def test_salt_pool(self):
+        bcrypt = self.make_bcrypt(BCRYPT_SALT_POOL_SIZE=4)
+        bcrypt.warmup()
+        salts = bcrypt.salt_pool._salts[4, b'2b']
+        self.assertEqual(len(salts), 4)
+        pooled = salts[0]
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertEqual(pw_hash[:29], pooled)
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+
+        taken = [bcrypt._gensalt() for _ in range(20)]
+        self.assertEqual(len(set(taken)), 20)
+        deadline = time.monotonic() + 5
+        while len(salts) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(salts), 4)
+
+    def test_salt_pool_cleared_after_fork(self):
+        bcrypt = self.make_bcrypt(BCRYPT_SALT_POOL_SIZE=4)
+        bcrypt.warmup()
+        flask_bcrypt._reset_executors_after_fork()
+        self.assertEqual(bcrypt.salt_pool._salts, {})
+
+    def test_empty_pool(self):
+        pool = SaltPool(2)
+        salt = pool.take(5, b'2a')
+        self.assertTrue(salt.startswith(b'$2a$05$'))
+        with self.assertRaises(ValueError):
+            SaltPool(0)
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        code = ('import sys, flask_bcrypt; '
+                'print(sorted(m for m in ("bcrypt", "asyncio", '
+                '"concurrent.futures") if m in sys.modules)); '
+                'flask_bcrypt.generate_password_hash("secret", 4); '
+                'print("bcrypt" in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(__file__) or '.')
+        self.assertEqual(output.decode().split(), ['[]', 'True'])
+
+    def test_bcrypt_attribute(self):
+        import bcrypt
+        self.assertIs(flask_bcrypt.bcrypt, bcrypt)
+        with self.assertRaises(AttributeError):
+            flask_bcrypt.missing
+
+    def test_helpers_share_instance(self):
+        with mock.patch.object(flask_bcrypt, 'Bcrypt',
+                               wraps=flask_bcrypt.Bcrypt) as cls, \
+                mock.patch.object(flask_bcrypt, '_default_instance', None):
+            pw_hash = generate_password_hash('secret', 4)
+            self.assertTrue(check_password_hash(pw_hash, 'secret'))
+            self.assertEqual(cls.call_count, 1)
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 6
+        self.executor = ThreadPoolExecutor(2)
+        self.bcrypt = Bcrypt(app, executor=self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_async_check_hash(self):
+        async def run():
+            pw_hash = await self.bcrypt.async_generate_password_hash('secret')
+            self.assertTrue(
+                await self.bcrypt.async_check_password_hash(pw_hash, 'secret'))
+            self.assertFalse(
+                await self.bcrypt.async_check_password_hash(pw_hash, 'nope'))
+            # sync and async hashes are interchangeable
+            self.assertTrue(self.bcrypt.check_password_hash(pw_hash, 'secret'))
+        asyncio.run(run())
+
+    def test_async_concurrent(self):
+        async def run():
+            hashes = await asyncio.gather(*[
+                self.bcrypt.async_generate_password_hash(str(i))
+                for i in range(4)])
+            results = await asyncio.gather(*[
+                self.bcrypt.async_check_password_hash(h, str(i))
+                for i, h in enumerate(hashes)])
+            self.assertEqual(results, [True] * 4)
+        asyncio.run(run())
+
+    def test_async_empty_password(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.bcrypt.async_generate_password_hash(''))
+
+    def test_async_helpers(self):
+        async def run():
+            pw_hash = await async_generate_password_hash('hunter2', 5)
+            self.assertTrue(
+                await async_check_password_hash(pw_hash, 'hunter2'))
+        asyncio.run(run())
+
+
+class CalibrationTestCase(unittest.TestCase):
+
+    def make_app(self, **config):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 14
+        app.config.update(config)
+        return app
+
+    def test_not_calibrated_by_default(self):
+        bcrypt = Bcrypt(self.make_app())
+        self.assertIsNone(bcrypt.calibration)
+        self.assertEqual(bcrypt._log_rounds, 14)
+
+    def test_target_ms(self):
+        bcrypt = Bcrypt(self.make_app(BCRYPT_TARGET_MS=1))
+        self.assertEqual(bcrypt._log_rounds, bcrypt.calibration.log_rounds)
+        self.assertGreaterEqual(bcrypt._log_rounds, 4)
+        self.assertLess(bcrypt._log_rounds, 14)
+        self.assertGreater(bcrypt.calibration.measured_ms, 0)
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertFalse(bcrypt.needs_rehash(pw_hash))
+
+    def test_time_budget(self):
+        bcrypt = Bcrypt(self.make_app())
+        calibration = bcrypt.calibrate(10 ** 6, max_seconds=0)
+        self.assertEqual(calibration.log_rounds, 4)
+
+    def test_cache_file(self):
+        fd, cache_file = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, cache_file)
+        self.addCleanup(os.remove, cache_file + '.lock')
+        with open(cache_file, 'w') as f:
+            json.dump({'target_ms': 250, 'prefix': '2b', 'log_rounds': 9,
+                       'measured_ms': 200.0}, f)
+
+        bcrypt = Bcrypt(self.make_app(BCRYPT_TARGET_MS=250,
+                                      BCRYPT_CALIBRATION_FILE=cache_file))
+        self.assertEqual(bcrypt.calibration, (9, 200.0))
+
+        # a different target is benchmarked again and stored
+        bcrypt = Bcrypt(self.make_app(BCRYPT_TARGET_MS=1,
+                                      BCRYPT_CALIBRATION_FILE=cache_file))
+        with open(cache_file) as f:
+            cached = json.load(f)
+        self.assertEqual(cached['target_ms'], 1)
+        self.assertEqual(cached['log_rounds'], bcrypt._log_rounds)
+
+    def test_cache_file_benchmarked_once(self):
+        directory = tempfile.mkdtemp()
+        cache_file = os.path.join(directory, 'calibration.json')
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, cache_file)
+        self.addCleanup(os.remove, cache_file + '.lock')
+        calls = []
+
+        def benchmark(self, target_ms, max_seconds, prefix):
+            calls.append(target_ms)
+            time.sleep(0.05)
+            return flask_bcrypt.Calibration(len(calls) + 4, 1.0)
+
+        bcrypt = Bcrypt(self.make_app())
+        with mock.patch.object(Bcrypt, '_calibrate', benchmark), \
+                ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda _: bcrypt.calibrate(250, cache_file=cache_file),
+                range(4)))
+        # workers starting together wait for the first one's result
+        self.assertEqual(calls, [250])
+        self.assertEqual(set(results), {(5, 1.0)})
+
+
+class VerificationCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_CACHE_ENABLED'] = True
+        app.config['BCRYPT_CACHE_MAX_ENTRIES'] = 2
+        self.bcrypt = Bcrypt(app)
+        self.pw_hash = self.bcrypt.generate_password_hash('secret')
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(Bcrypt(flask.Flask(__name__)).verification_cache)
+
+    def test_success_is_cached(self):
+        self.assertTrue(self.bcrypt.check_password_hash(self.pw_hash, 'secret'))
+        with mock.patch.object(flask_bcrypt.bcrypt, 'hashpw') as hashpw:
+            self.assertTrue(
+                self.bcrypt.check_password_hash(self.pw_hash, 'secret'))
+            self.assertFalse(hashpw.called)
+            # a different password is never answered from the cache
+            hashpw.return_value = b'mismatch'
+            self.assertFalse(
+                self.bcrypt.check_password_hash(self.pw_hash, 'hunter2'))
+            self.assertTrue(hashpw.called)
+
+    def test_failure_is_not_cached(self):
+        self.assertFalse(self.bcrypt.check_password_hash(self.pw_hash, 'nope'))
+        self.assertEqual(len(self.bcrypt.verification_cache.backend), 0)
+
+    def test_invalidate(self):
+        self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+        self.bcrypt.invalidate_cached(self.pw_hash.decode('utf-8'))
+        self.assertEqual(len(self.bcrypt.verification_cache.backend), 0)
+
+    def test_no_plaintext_stored(self):
+        cache = VerificationCache(b'key')
+        cache.add(b'$2b$04$hash', b'secret')
+        for slot, (token, _) in cache.backend._entries.items():
+            self.assertNotIn(b'secret', slot.encode('ascii') + token)
+            self.assertNotIn(b'hash', slot.encode('ascii') + token)
+
+    def test_eviction_and_ttl(self):
+        cache = VerificationCache(b'key', max_entries=2, ttl=60)
+        for pw_hash in (b'a', b'b', b'c'):
+            cache.add(pw_hash, b'secret')
+        self.assertFalse(cache.get(b'a', b'secret'))
+        self.assertTrue(cache.get(b'c', b'secret'))
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertFalse(cache.get(b'c', b'secret'))
+
+
+class FakeKeyValueStore(object):
+    '''A minimal in-memory stand-in for a Redis client.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        value, expires = self.data.get(name, (None, None))
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def set(self, name, value, ex=None):
+        self.data[name] = (value, time.time() + ex if ex else None)
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+    def scan_iter(self, match):
+        return [name for name in self.data if name.startswith(match[:-1])]
+
+    def eval(self, script, numkeys, name, capacity, rate, now):
+        # Stands in for KeyValueRateLimitBackend.script.
+        assert script == KeyValueRateLimitBackend.script and numkeys == 1
+        capacity, rate, now = float(capacity), float(rate), float(now)
+        value = self.get(name)
+        tokens, updated = capacity, now
+        if value is not None:
+            tokens, updated = (float(v) for v in value.split(b':'))
+        tokens, retry_after = RateLimitBackend._refill(
+            tokens, updated, now, capacity, rate)
+        self.set(name, '{0!r}:{1!r}'.format(tokens, now).encode('ascii'),
+                 ex=max(1, int((capacity - tokens) / rate) + 1))
+        return str(retry_after).encode('ascii')
+
+
+class SharedCacheBackendTestCase(unittest.TestCase):
+
+    def make_bcrypt(self, backend, key='shared'):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_CACHE_ENABLED'] = True
+        app.config['BCRYPT_CACHE_BACKEND'] = backend
+        app.config['BCRYPT_CACHE_KEY'] = key
+        return Bcrypt(app)
+
+    def assert_shared(self, backend):
+        first, second = self.make_bcrypt(backend), self.make_bcrypt(backend)
+        pw_hash = first.generate_password_hash('secret')
+        self.assertTrue(first.check_password_hash(pw_hash, 'secret'))
+        with mock.patch.object(flask_bcrypt.bcrypt, 'hashpw') as hashpw:
+            self.assertTrue(second.check_password_hash(pw_hash, 'secret'))
+            self.assertFalse(hashpw.called)
+        # a worker with another key cannot use the entries
+        other = self.make_bcrypt(backend, key='other')
+        self.assertIsNone(other.verification_cache.backend.get(
+            other.verification_cache._slot(pw_hash)))
+        second.invalidate_cached(pw_hash)
+        self.assertFalse(first.verification_cache.get(pw_hash, b'secret'))
+
+    def test_key_required(self):
+        for backend in ('file', KeyValueCacheBackend(FakeKeyValueStore())):
+            with self.assertRaises(ValueError):
+                self.make_bcrypt(backend, key=None)
+        self.assertIsNotNone(self.make_bcrypt('memory', key=None)
+                             .verification_cache)
+
+    def test_file_backend(self):
+        directory = tempfile.mkdtemp()
+        backend = FileCacheBackend(directory)
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(backend.clear)
+        self.assert_shared(backend)
+
+    def test_file_backend_expiry(self):
+        directory = tempfile.mkdtemp()
+        backend = FileCacheBackend(directory)
+        self.addCleanup(os.rmdir, directory)
+        backend.set('a', b'value', 60)
+        backend.set('b', b'value', -1)
+        self.assertEqual(backend.get('a'), b'value')
+        self.assertIsNone(backend.get('b'))
+        backend.set('c', b'value', -1)
+        backend.prune()
+        self.assertEqual(os.listdir(directory), ['a'])
+        backend.clear()
+
+    def test_file_backend_bounded(self):
+        directory = tempfile.mkdtemp()
+        backend = FileCacheBackend(directory, max_entries=2)
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(backend.clear)
+        backend.set('expired', b'value', -1)
+        for i in range(20):
+            backend.set(str(i), b'value', 60)
+            self.assertLessEqual(len(os.listdir(directory)), 2)
+        self.assertEqual(sorted(os.listdir(directory)), ['18', '19'])
+
+    def test_file_backend_private_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        os.chmod(directory, 0o777)
+        with self.assertRaises(ValueError):
+            FileCacheBackend(directory)
+        os.chmod(directory, 0o700)
+        FileCacheBackend(directory)
+
+    def test_key_value_backend(self):
+        store = FakeKeyValueStore()
+        self.assert_shared(KeyValueCacheBackend(store))
+        self.assertTrue(all(name.startswith('flask-bcrypt:')
+                            for name in store.data))
+        KeyValueCacheBackend(store).clear()
+        self.assertEqual(store.data, {})
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            self.make_bcrypt('memcached')
+
+
+class RateLimitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_RATE_LIMIT_CAPACITY'] = 2
+        app.config['BCRYPT_RATE_LIMIT_PER_SECOND'] = 0.5
+        self.bcrypt = Bcrypt(app)
+        self.pw_hash = self.bcrypt.generate_password_hash('secret')
+
+    def test_disabled_by_default(self):
+        bcrypt = Bcrypt(flask.Flask(__name__))
+        self.assertIsNone(bcrypt.rate_limiter)
+        bcrypt.check_password_hash(self.pw_hash, 'secret', identity='alice')
+
+    def test_rejects_before_hashing(self):
+        for _ in range(2):
+            self.assertFalse(self.bcrypt.check_password_hash(
+                self.pw_hash, 'wrong', identity='alice'))
+        with mock.patch.object(flask_bcrypt.bcrypt, 'hashpw') as hashpw:
+            with self.assertRaises(RateLimitExceededError) as cm:
+                self.bcrypt.check_password_hash(self.pw_hash, 'secret',
+                                                identity='alice')
+            self.assertFalse(hashpw.called)
+        self.assertAlmostEqual(cm.exception.retry_after, 2, places=1)
+        self.assertEqual(
+            self.bcrypt.metrics.snapshot()['counters']['rate_limited'], 1)
+        # other identities and calls without an identity are unaffected
+        self.assertTrue(self.bcrypt.check_password_hash(
+            self.pw_hash, 'secret', identity='bob'))
+        self.assertTrue(self.bcrypt.check_password_hash(self.pw_hash,
+                                                        'secret'))
+
+    def test_multiple_identities(self):
+        self.bcrypt.check_password_hash(self.pw_hash, 'secret',
+                                        identity=['alice', '10.0.0.1'])
+        self.bcrypt.check_password_hash(self.pw_hash, 'secret',
+                                        identity=['bob', '10.0.0.1'])
+        with self.assertRaises(RateLimitExceededError):
+            asyncio.run(self.bcrypt.async_check_password_hash(
+                self.pw_hash, 'secret', identity=['carol', '10.0.0.1']))
+
+    def test_refill(self):
+        limiter = RateLimiter(1, 10)
+        limiter.consume('alice')
+        with self.assertRaises(RateLimitExceededError):
+            limiter.consume('alice')
+        time.sleep(0.11)
+        limiter.consume('alice')
+
+    def test_memory_backend_eviction(self):
+        backend = MemoryRateLimitBackend(max_keys=2)
+        limiter = RateLimiter(1, 0.001, backend=backend)
+        for identity in ('a', 'b', 'c'):
+            limiter.consume(identity)
+        self.assertEqual(len(backend), 2)
+        # the evicted identity starts over with a full bucket
+        limiter.consume('a')
+        with self.assertRaises(RateLimitExceededError):
+            limiter.consume('c')
+
+    def test_key_value_backend(self):
+        store = FakeKeyValueStore()
+        first = RateLimiter(2, 0.001, KeyValueRateLimitBackend(store))
+        second = RateLimiter(2, 0.001, KeyValueRateLimitBackend(store))
+        first.consume('alice')
+        second.consume('alice')
+        with self.assertRaises(RateLimitExceededError):
+            first.consume('alice')
+        self.assertFalse(any('alice' in name for name in store.data))
+
+
+class HashingLimiterTestCase(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(Bcrypt(flask.Flask(__name__)).limiter)
+
+    def test_reject_when_saturated(self):
+        limiter = HashingLimiter(1)
+        limiter.acquire()
+        with self.assertRaises(HashingSaturatedError):
+            limiter.acquire()
+        self.assertEqual(limiter.stats(),
+                         {'in_flight': 1, 'queued': 0, 'rejected': 1})
+        limiter.release()
+        limiter.acquire()
+        limiter.release()
+
+    def test_queue_timeout(self):
+        limiter = HashingLimiter(1, max_queue=1, queue_timeout=0.01)
+        limiter.acquire()
+        with self.assertRaises(HashingSaturatedError):
+            limiter.acquire()
+        self.assertEqual(limiter.stats(),
+                         {'in_flight': 1, 'queued': 0, 'rejected': 1})
+
+    def test_queued_caller_is_admitted(self):
+        limiter = HashingLimiter(1, max_queue=1)
+        limiter.acquire()
+        with ThreadPoolExecutor(1) as executor:
+            waiter = executor.submit(limiter.acquire)
+            while not limiter.queued:
+                time.sleep(0.001)
+            # the queue is full now
+            with self.assertRaises(HashingSaturatedError):
+                limiter.acquire()
+            limiter.release()
+            waiter.result(timeout=5)
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_async_waiters_do_not_hold_threads(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        app.config['BCRYPT_MAX_QUEUE'] = 50
+        bcrypt = Bcrypt(app)
+
+        async def run():
+            # queued callers used to block every thread of the default
+            # executor, leaving none to compute the admitted hash
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(4))
+            return await asyncio.wait_for(asyncio.gather(*[
+                bcrypt.async_generate_password_hash(str(i))
+                for i in range(8)]), 20)
+
+        self.assertEqual(len(asyncio.run(run())), 8)
+        self.assertEqual(bcrypt.limiter.stats(),
+                         {'in_flight': 0, 'queued': 0, 'rejected': 0})
+
+    def test_async_cancelled_waiter(self):
+        limiter = HashingLimiter(1, max_queue=2)
+        limiter.acquire()
+
+        async def run():
+            waiter = asyncio.ensure_future(limiter.async_acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.queued, 1)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertEqual(limiter.queued, 0)
+
+            # a slot handed over just before the cancellation is given back
+            waiter = asyncio.ensure_future(limiter.async_acquire())
+            await asyncio.sleep(0)
+            limiter.release()
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+        asyncio.run(run())
+        self.assertEqual(limiter.stats(),
+                         {'in_flight': 0, 'queued': 0, 'rejected': 0})
+
+    def test_async_queue_timeout(self):
+        limiter = HashingLimiter(1, max_queue=1, queue_timeout=0.01)
+        limiter.acquire()
+        with self.assertRaises(HashingSaturatedError):
+            asyncio.run(limiter.async_acquire())
+        self.assertEqual(limiter.stats(),
+                         {'in_flight': 1, 'queued': 0, 'rejected': 1})
+
+    def test_rehash_skipped_when_saturated(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        app.config['BCRYPT_CACHE_ENABLED'] = True
+        bcrypt = Bcrypt(app)
+        stale = bcrypt.generate_password_hash('secret', 5)
+        self.assertTrue(bcrypt.check_password_hash(stale, 'secret'))
+        # the cached check succeeds, the rehash is refused
+        bcrypt.limiter.acquire()
+        self.assertEqual(bcrypt.check_and_rehash(stale, 'secret'),
+                         (True, None))
+
+    def test_bcrypt_fails_fast(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        bcrypt = Bcrypt(app)
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertEqual(bcrypt.limiter.in_flight, 0)
+
+        bcrypt.limiter.acquire()
+        with self.assertRaises(HashingSaturatedError):
+            bcrypt.check_password_hash(pw_hash, 'secret')
+        with self.assertRaises(HashingSaturatedError):
+            asyncio.run(bcrypt.async_generate_password_hash('secret'))
+        self.assertEqual(bcrypt.limiter.rejected, 2)
+
+
+class RequestBudgetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app.config['BCRYPT_REQUEST_MAX_OPERATIONS'] = 1
+        self.app.config['BCRYPT_REQUEST_TIMEOUT_HEADER'] = 'X-Timeout'
+        self.bcrypt = Bcrypt(self.app)
+        self.pw_hash = self.bcrypt.generate_password_hash('secret')
+
+        @self.app.route('/change-password')
+        def change_password():
+            try:
+                self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+                self.bcrypt.generate_password_hash('new secret')
+            except HashingBudgetExceededError:
+                return 'busy', 503
+            return 'ok'
+
+        self.client = self.app.test_client()
+
+    def test_no_budget_outside_requests(self):
+        self.assertIsNone(self.bcrypt.get_request_budget())
+        self.bcrypt.generate_password_hash('secret')
+        self.bcrypt.generate_password_hash('secret')
+
+    def test_max_operations(self):
+        self.assertEqual(self.client.get('/change-password').status_code, 503)
+        counters = self.bcrypt.metrics.snapshot()['counters']
+        self.assertEqual(counters['budget_exceeded'], 1)
+
+    def test_set_request_budget(self):
+        with self.app.test_request_context():
+            budget = self.bcrypt.set_request_budget(max_operations=2)
+            self.assertIs(self.bcrypt.get_request_budget(), budget)
+            self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+            self.bcrypt.generate_password_hash('new secret')
+            self.assertEqual(budget.remaining_operations(), 0)
+            self.assertIsNone(budget.remaining_seconds())
+
+    def test_deadline(self):
+        with self.app.test_request_context():
+            self.bcrypt.set_request_budget(timeout=60)
+            self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+            # hashes at cost 31 are estimated from those seen at cost 4
+            with self.assertRaises(HashingBudgetExceededError):
+                self.bcrypt.generate_password_hash('secret', 31)
+            self.bcrypt.set_request_budget(timeout=0)
+            with self.assertRaises(HashingBudgetExceededError):
+                self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+
+    def test_rehash_is_optional(self):
+        stale = self.bcrypt.generate_password_hash('secret', 5)
+
+        @self.app.route('/login')
+        def login():
+            valid, new_hash = self.bcrypt.check_and_rehash(stale, 'secret')
+            return 'ok' if valid and new_hash is None else 'unexpected'
+
+        response = self.client.get('/login')
+        self.assertEqual(response.data, b'ok')
+
+    def test_timeout_header(self):
+        self.app.config['BCRYPT_REQUEST_MAX_OPERATIONS'] = None
+        response = self.client.get('/change-password',
+                                   headers={'X-Timeout': '0'})
+        self.assertEqual(response.status_code, 503)
+
+    def test_deadline_cuts_queue_wait(self):
+        self.app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        self.app.config['BCRYPT_MAX_QUEUE'] = 1
+        bcrypt = Bcrypt(self.app)
+        bcrypt.limiter.acquire()
+        with self.app.test_request_context():
+            bcrypt.set_request_budget(timeout=0.05)
+            start = time.monotonic()
+            with self.assertRaises(HashingSaturatedError):
+                bcrypt.generate_password_hash('secret')
+            self.assertLess(time.monotonic() - start, 1)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.bcrypt = Bcrypt(app)
+
+    def test_snapshot(self):
+        pw_hash = self.bcrypt.generate_password_hash('secret')
+        self.bcrypt.check_password_hash(pw_hash, 'secret')
+        self.bcrypt.check_password_hash(pw_hash, 'wrong')
+        self.bcrypt.check_and_rehash(
+            self.bcrypt.generate_password_hash('secret', 5), 'secret')
+
+        snapshot = self.bcrypt.metrics.snapshot()
+        self.assertEqual(snapshot['counters']['check_success'], 2)
+        self.assertEqual(snapshot['counters']['check_failure'], 1)
+        self.assertEqual(snapshot['counters']['rehash'], 1)
+        latency = {(e['operation'], e['cost'], e['prefix']): e['count']
+                   for e in snapshot['latency']}
+        self.assertEqual(latency, {('generate', 4, '2b'): 2,
+                                   ('generate', 5, '2b'): 1,
+                                   ('check', 4, '2b'): 2,
+                                   ('check', 5, '2b'): 1})
+        wait = {e['operation']: e['count'] for e in snapshot['wait']}
+        self.assertEqual(wait, {'generate': 3, 'check': 3})
+
+        self.bcrypt.metrics.reset()
+        snapshot = self.bcrypt.metrics.snapshot()
+        self.assertEqual(snapshot['latency'], [])
+        self.assertEqual(snapshot['counters']['check_success'], 0)
+
+    def test_buckets(self):
+        metrics = HashingMetrics(buckets=(0.1, 1.0))
+        for duration in (0.05, 0.1, 0.5, 5.0):
+            metrics.observe('check', 12, '2b', duration)
+        entry = metrics.snapshot()['latency'][0]
+        self.assertEqual(entry['buckets'],
+                         [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+        self.assertEqual(entry['count'], 4)
+        self.assertAlmostEqual(entry['sum'], 5.65)
+
+    def test_prometheus(self):
+        metrics = HashingMetrics(buckets=(0.1,))
+        metrics.observe('check', 12, '2b', 0.05, wait=0.2)
+        metrics.increment('check_success')
+        text = metrics.prometheus()
+        self.assertIn('# TYPE flask_bcrypt_hash_duration_seconds histogram',
+                      text)
+        self.assertIn('flask_bcrypt_hash_duration_seconds_bucket{operation='
+                      '"check",cost="12",prefix="2b",le="0.1"} 1', text)
+        self.assertIn('flask_bcrypt_queue_wait_seconds_bucket{operation='
+                      '"check",le="+Inf"} 1', text)
+        self.assertIn('flask_bcrypt_check_success_total 1', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_signals(self):
+        events = []
+
+        def started(sender, **kwargs):
+            events.append(('started', sender, kwargs))
+
+        def finished(sender, **kwargs):
+            events.append(('finished', sender, kwargs))
+
+        with hash_started.connected_to(started), \
+                hash_finished.connected_to(finished):
+            self.bcrypt.generate_password_hash('secret')
+
+        self.assertEqual([(e[0], e[1]) for e in events],
+                         [('started', self.bcrypt), ('finished', self.bcrypt)])
+        self.assertEqual(events[0][2],
+                         {'operation': 'generate', 'cost': 4, 'prefix': '2b'})
+        self.assertGreater(events[1][2]['duration'], 0)
+        self.assertGreaterEqual(events[1][2]['wait'], 0)
+
+    def test_rejections_counted(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        bcrypt = Bcrypt(app)
+        bcrypt.limiter.acquire()
+        with self.assertRaises(HashingSaturatedError):
+            bcrypt.generate_password_hash('secret')
+        self.assertEqual(bcrypt.metrics.snapshot()['counters']['rejected'], 1)
+
+
+class FakeTracer(object):
+    '''Records the calls an OpenTelemetry tracer would receive.'''
+
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, attributes=None, start_time=None):
+        span = mock.Mock()
+        self.spans.append((name, attributes, start_time, span))
+        return span
+
+
+class ProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app.config['BCRYPT_PROFILE'] = True
+        self.bcrypt = Bcrypt(self.app)
+        self.pw_hash = self.bcrypt.generate_password_hash('secret')
+
+        @self.app.route('/login')
+        def login():
+            self.spans = self.bcrypt.get_request_spans()
+            return str(self.bcrypt.check_password_hash(self.pw_hash,
+                                                       'secret'))
+
+        @self.app.route('/ping')
+        def ping():
+            return 'pong'
+
+        self.client = self.app.test_client()
+
+    def test_spans(self):
+        with self.app.test_request_context():
+            self.assertEqual(self.bcrypt.get_request_spans(), [])
+            self.bcrypt.check_password_hash(self.pw_hash, 'secret')
+            self.bcrypt.dummy_check()
+            spans = self.bcrypt.get_request_spans()
+        self.assertEqual([(s.operation, s.prefix, s.cost, s.executor)
+                          for s in spans],
+                         [('check', '2b', 4, 'inline')] * 2)
+        self.assertIsInstance(spans[0], HashingSpan)
+        self.assertGreater(spans[0].duration, 0)
+        self.assertGreaterEqual(spans[0].wait, 0)
+        self.assertLessEqual(spans[0].start, time.time())
+        self.assertEqual(self.bcrypt.get_request_spans(), [])
+
+    def test_executor_names(self):
+        with self.app.test_request_context():
+            asyncio.run(self.bcrypt.async_generate_password_hash('secret'))
+            self.app.config['BCRYPT_EXECUTOR'] = 'thread'
+            bcrypt = Bcrypt(self.app)
+            self.addCleanup(bcrypt.shutdown_executor)
+            bcrypt.generate_password_hash('secret')
+            with ThreadPoolExecutor(1) as executor:
+                Bcrypt(self.app, executor=executor).generate_password_hash('x')
+            executors = [s.executor for s in bcrypt.get_request_spans()]
+        self.assertEqual(executors, ['loop', 'thread', 'ThreadPoolExecutor'])
+
+    def test_server_timing(self):
+        with self.assertLogs(self.app.logger, 'INFO') as logs:
+            response = self.client.get('/login')
+        self.assertEqual(response.data, b'True')
+        self.assertEqual(self.spans, [])
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^bcrypt;dur=[0-9.]+;desc="1 hashes", '
+                         r'bcrypt-wait;dur=[0-9.]+$')
+        self.assertRegex(logs.output[0],
+                         r'GET /login spent [0-9.]+ ms hashing and [0-9.]+ '
+                         r'ms waiting: check 2b/4 on inline [0-9.]+\+')
+
+    def test_no_hashing(self):
+        response = self.client.get('/ping')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_disabled(self):
+        self.app.config['BCRYPT_PROFILE'] = False
+        bcrypt = Bcrypt(self.app)
+        with self.app.test_request_context():
+            bcrypt.generate_password_hash('secret')
+            self.assertEqual(bcrypt.get_request_spans(), [])
+
+    def test_tracer(self):
+        tracer = FakeTracer()
+        self.app.config['BCRYPT_PROFILE'] = False
+        self.app.config['BCRYPT_TRACER'] = tracer
+        bcrypt = Bcrypt(self.app)
+        bcrypt.generate_password_hash('secret')
+        self.assertEqual(bcrypt.get_request_spans(), [])
+
+        (name, attributes, start_time, span), = tracer.spans
+        self.assertEqual(name, 'bcrypt.generate')
+        self.assertEqual(attributes['bcrypt.cost'], 4)
+        self.assertEqual(attributes['bcrypt.prefix'], '2b')
+        self.assertEqual(attributes['bcrypt.executor'], 'inline')
+        self.assertGreater(attributes['bcrypt.duration_ms'], 0)
+        self.assertIsInstance(start_time, int)
+        admitted = span.add_event.call_args[1]['timestamp']
+        end_time = span.end.call_args[1]['end_time']
+        self.assertLessEqual(start_time, admitted)
+        self.assertLess(admitted, end_time)
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+    def make_bcrypt(self, executor_type, max_workers=2):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_EXECUTOR'] = executor_type
+        app.config['BCRYPT_MAX_WORKERS'] = max_workers
+        bcrypt = Bcrypt(app)
+        self.addCleanup(bcrypt.shutdown_executor)
+        return bcrypt
+
+    def test_no_executor_by_default(self):
+        self.assertIsNone(Bcrypt(flask.Flask(__name__)).get_executor())
+
+    def test_executor_is_lazy(self):
+        bcrypt = self.make_bcrypt('thread')
+        self.assertIsNone(bcrypt._state().managed_executor)
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertIsInstance(bcrypt._state().managed_executor,
+                              ThreadPoolExecutor)
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+        self.assertFalse(bcrypt.check_password_hash(pw_hash, 'hunter2'))
+
+    def test_process_executor(self):
+        bcrypt = self.make_bcrypt('process', 1)
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+
+    def test_shutdown_restarts(self):
+        bcrypt = self.make_bcrypt('thread')
+        bcrypt.generate_password_hash('secret')
+        bcrypt.shutdown_executor()
+        self.assertIsNone(bcrypt._state().managed_executor)
+        pw_hash = bcrypt.generate_password_hash('secret')
+        self.assertTrue(bcrypt.check_password_hash(pw_hash, 'secret'))
+
+    def test_invalid_executor(self):
+        with self.assertRaises(ValueError):
+            self.make_bcrypt('fiber')
+
+
+class RehashTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.bcrypt = Bcrypt(app)
+
+    def test_needs_rehash(self):
+        current = self.bcrypt.generate_password_hash('secret')
+        self.assertFalse(self.bcrypt.needs_rehash(current))
+        self.assertFalse(self.bcrypt.needs_rehash(current.decode('utf-8')))
+        self.assertTrue(self.bcrypt.needs_rehash(
+            self.bcrypt.generate_password_hash('secret', 4)))
+        self.assertTrue(self.bcrypt.needs_rehash(
+            self.bcrypt.generate_password_hash('secret', prefix='2a')))
+        self.assertTrue(self.bcrypt.needs_rehash('not a hash'))
+
+    def test_check_and_rehash(self):
+        stale = self.bcrypt.generate_password_hash('secret', 4)
+        self.assertEqual(self.bcrypt.check_and_rehash(stale, 'wrong'),
+                         (False, None))
+        valid, new_hash = self.bcrypt.check_and_rehash(stale, 'secret')
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith(b'$2b$05$'))
+        self.assertTrue(self.bcrypt.check_password_hash(new_hash, 'secret'))
+        self.assertEqual(self.bcrypt.check_and_rehash(new_hash, 'secret'),
+                         (True, None))
+
+
+class PasswordHashTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.bcrypt = Bcrypt(app)
+        self.pw_hash = self.bcrypt.generate_password_hash('secret')
+
+    def test_parts(self):
+        parsed = PasswordHash(self.pw_hash)
+        self.assertEqual(parsed.prefix, '2b')
+        self.assertEqual(parsed.cost, 5)
+        self.assertIsInstance(parsed.salt, memoryview)
+        self.assertEqual(parsed.salt.tobytes(), self.pw_hash[7:29])
+        self.assertEqual(parsed.digest.tobytes(), self.pw_hash[29:])
+        self.assertIs(parsed.salt.obj, parsed.raw)
+        self.assertFalse(hasattr(parsed, '__dict__'))
+
+    def test_conversions(self):
+        parsed = PasswordHash(self.pw_hash.decode('utf-8'))
+        self.assertEqual(parsed, self.pw_hash)
+        self.assertEqual(parsed, self.pw_hash.decode('utf-8'))
+        self.assertEqual(bytes(parsed), self.pw_hash)
+        self.assertEqual(parsed.decode(), self.pw_hash.decode('utf-8'))
+        self.assertEqual(repr(parsed), '<PasswordHash $2b$05$...>')
+
+    def test_malformed(self):
+        for value in ('', 'secret', '$2b$xx$' + 'a' * 53, self.pw_hash[:-1]):
+            with self.assertRaises(ValueError):
+                PasswordHash(value)
+
+    def test_bcrypt_accepts_parsed(self):
+        parsed = self.bcrypt.generate_password_hash('secret', parsed=True)
+        self.assertIsInstance(parsed, PasswordHash)
+        self.assertTrue(self.bcrypt.check_password_hash(parsed, 'secret'))
+        self.assertFalse(self.bcrypt.check_password_hash(parsed, 'wrong'))
+        self.assertTrue(asyncio.run(
+            self.bcrypt.async_check_password_hash(parsed, 'secret')))
+        self.assertFalse(self.bcrypt.needs_rehash(parsed))
+        self.assertTrue(self.bcrypt.needs_rehash(PasswordHash(
+            self.bcrypt.generate_password_hash('secret', 4))))
+        self.assertEqual(
+            list(self.bcrypt.check_password_hashes([(parsed, 'secret')])),
+            [True])
+
+
+class ScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        self.bcrypt = Bcrypt(app)
+        self.runner = app.test_cli_runner()
+        self.hashes = [self.bcrypt.generate_password_hash('secret', rounds)
+                       for rounds in (4, 4, 5)]
+        self.hashes.append(
+            self.bcrypt.generate_password_hash('secret', 4, prefix='2a'))
+        self.hashes.append(b'not a hash')
+
+    def test_scan_hashes(self):
+        expected = {'$2b$04': 2, '$2b$05': 1, '$2a$04': 1, 'malformed': 1}
+        self.assertEqual(scan_hashes(self.hashes), expected)
+        self.assertEqual(scan_hashes(self.hashes, chunk_size=2, jobs=2),
+                         expected)
+        self.assertEqual(
+            scan_hashes(h.decode('utf-8') for h in self.hashes), expected)
+
+    def test_scan_command(self):
+        result = self.runner.invoke(args=['bcrypt', 'scan', '--json'],
+                                    input=b'\n'.join(self.hashes) + b'\n')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(json.loads(result.output), {
+            'total': 5,
+            'hashes': {'$2b$04': 2, '$2b$05': 1, '$2a$04': 1,
+                       'malformed': 1}})
+
+    def test_scan_command_file(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\n'.join(self.hashes))
+        result = self.runner.invoke(args=['bcrypt', 'scan', '-j', '1', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Scanned 5 hashes', result.output)
+        self.assertIn('$2b$04', result.output)
+
+    def test_sql_requires_uri(self):
+        result = self.runner.invoke(args=['bcrypt', 'scan', '--sql',
+                                          'select password from users'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('SQLALCHEMY_DATABASE_URI', result.output)
+
+
+class LegacyHashTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.bcrypt = Bcrypt(app)
+        self.pbkdf2 = werkzeug_hash('secret', method='pbkdf2:sha256:1000')
+        self.scrypt = werkzeug_hash('secret', method='scrypt:1024:8:1')
+
+    def test_check_werkzeug_hashes(self):
+        for legacy in (self.pbkdf2, self.scrypt):
+            self.assertTrue(self.bcrypt.check_password_hash(legacy, 'secret'))
+            self.assertFalse(self.bcrypt.check_password_hash(legacy, 'nope'))
+            self.assertTrue(self.bcrypt.needs_rehash(legacy))
+            self.assertTrue(asyncio.run(
+                self.bcrypt.async_check_password_hash(legacy, 'secret')))
+
+    def test_werkzeug_hashes_are_admitted(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        app.config['BCRYPT_CACHE_ENABLED'] = True
+        bcrypt = Bcrypt(app)
+        wrapped = bcrypt.wrap_legacy_hash(self.pbkdf2, rounds=4)
+        for legacy in (self.pbkdf2, wrapped):
+            self.assertTrue(bcrypt.check_password_hash(legacy, 'secret'))
+            self.assertFalse(asyncio.run(
+                bcrypt.async_check_password_hash(legacy, 'nope')))
+        latency = {(e['prefix'], e['cost']): e['count']
+                   for e in bcrypt.metrics.snapshot()['latency']
+                   if e['operation'] == 'check'}
+        self.assertEqual(latency, {('pbkdf2:sha256', 1000): 2,
+                                   ('pbkdf2:sha256+2b', 4): 2})
+
+        # cached verifications skip the werkzeug digest as well
+        self.assertTrue(bcrypt.check_password_hash(wrapped, 'secret'))
+        self.assertEqual(bcrypt.metrics.snapshot()['counters']['cache_hit'],
+                         1)
+
+        bcrypt.limiter.acquire()
+        for legacy in (self.pbkdf2, wrapped):
+            with self.assertRaises(HashingSaturatedError):
+                bcrypt.check_password_hash(legacy, 'nope')
+            with self.assertRaises(HashingSaturatedError):
+                asyncio.run(bcrypt.async_check_password_hash(legacy, 'nope'))
+
+    def test_batch_check_werkzeug_hashes(self):
+        pairs = [(self.pbkdf2, 'secret'), (self.scrypt, 'nope'),
+                 (self.scrypt, 'secret')]
+        self.assertEqual(list(self.bcrypt.check_password_hashes(pairs)),
+                         [True, False, True])
+
+    def test_check_2a(self):
+        pw_hash = self.bcrypt.generate_password_hash('secret', prefix='2a')
+        valid, new_hash = self.bcrypt.check_and_rehash(pw_hash, 'secret')
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith(b'$2b$04$'))
+
+    def test_wrap(self):
+        for legacy in (self.pbkdf2, self.scrypt):
+            wrapped = self.bcrypt.wrap_legacy_hash(legacy)
+            method, salt, _ = legacy.split('$')
+            self.assertTrue(wrapped.startswith(
+                '$fbw${0}${1}$2b$04$'.format(method, salt).encode('ascii')))
+            self.assertTrue(self.bcrypt.check_password_hash(wrapped, 'secret'))
+            self.assertFalse(self.bcrypt.check_password_hash(wrapped, 'nope'))
+            self.assertTrue(asyncio.run(
+                self.bcrypt.async_check_password_hash(wrapped, 'secret')))
+            self.assertEqual(list(self.bcrypt.check_password_hashes(
+                [(wrapped, 'secret'), (wrapped, 'nope')])), [True, False])
+
+            valid, new_hash = self.bcrypt.check_and_rehash(wrapped, 'secret')
+            self.assertTrue(valid)
+            self.assertFalse(self.bcrypt.needs_rehash(new_hash))
+
+    def test_wrap_rejects_other_hashes(self):
+        with self.assertRaises(ValueError):
+            self.bcrypt.wrap_legacy_hash(
+                self.bcrypt.generate_password_hash('secret'))
+        with self.assertRaises(ValueError):
+            self.bcrypt.wrap_legacy_hash('pbkdf2:sha256$salt$abcdef')
+
+    def test_scan_labels(self):
+        report = scan_hashes([self.pbkdf2,
+                              self.bcrypt.wrap_legacy_hash(self.pbkdf2)])
+        self.assertEqual(report, {'pbkdf2:sha256:1000': 1,
+                                  '$2b$04 wrapping pbkdf2:sha256:1000': 1})
+
+    def test_migration(self):
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(checkpoint)
+        self.addCleanup(lambda: os.path.exists(checkpoint) and
+                        os.remove(checkpoint))
+
+        native = self.bcrypt.generate_password_hash('secret')
+        table = {1: self.pbkdf2, 2: native, 3: self.scrypt,
+                 4: 'pbkdf2:sha256$salt$abcdef', 5: self.pbkdf2}
+        rows = sorted(table.items())
+
+        def save(key, new_hash):
+            table[key] = new_hash
+
+        # the first run is interrupted while committing its second batch
+        batches = []
+
+        def interrupt():
+            batches.append(None)
+            if len(batches) == 2:
+                raise KeyboardInterrupt
+
+        migration = LegacyHashMigration(self.bcrypt, rows, save,
+                                        checkpoint_file=checkpoint,
+                                        batch_size=2, on_batch=interrupt)
+        with self.assertRaises(KeyboardInterrupt):
+            migration.run()
+        self.assertTrue(table[1].startswith(b'$fbw$'))
+        self.assertEqual(table[2], native)
+
+        migration = LegacyHashMigration(self.bcrypt, rows, save,
+                                        checkpoint_file=checkpoint,
+                                        batch_size=2)
+        self.assertEqual(migration.position, 2)
+        stats = migration.run()
+        self.assertEqual(stats, {'migrated': 2, 'skipped': 0, 'failed': 1})
+        for key in (1, 3, 5):
+            self.assertTrue(self.bcrypt.check_password_hash(table[key],
+                                                            'secret'))
+
+        # a completed migration resumes at the end
+        migration = LegacyHashMigration(self.bcrypt, rows, save,
+                                        checkpoint_file=checkpoint)
+        self.assertEqual(migration.position, 5)
+        self.assertEqual(migration.run(),
+                         {'migrated': 0, 'skipped': 0, 'failed': 0})
+
+    def test_migration_skips_limiter(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['BCRYPT_MAX_CONCURRENCY'] = 1
+        bcrypt = Bcrypt(app)
+        # live logins hold every slot
+        bcrypt.limiter.acquire()
+        table = dict(enumerate([self.pbkdf2] * 8))
+        migration = LegacyHashMigration(bcrypt, sorted(table.items()),
+                                        table.__setitem__, workers=4)
+        self.assertEqual(migration.run(),
+                         {'migrated': 8, 'skipped': 0, 'failed': 0})
+        self.assertEqual(bcrypt.limiter.stats(),
+                         {'in_flight': 1, 'queued': 0, 'rejected': 0})
+
+    def test_migration_single_worker_by_default(self):
+        migration = LegacyHashMigration(self.bcrypt, [],
+                                        lambda key, new_hash: None)
+        self.assertEqual(migration.workers, 1)
+
+
+class DummyCheckTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.bcrypt = Bcrypt(app)
+
+    def test_dummy_check(self):
+        self.assertFalse(self.bcrypt.dummy_check('secret'))
+        self.assertFalse(self.bcrypt.dummy_check())
+        self.assertFalse(asyncio.run(self.bcrypt.async_dummy_check('secret')))
+        latency = self.bcrypt.metrics.snapshot()['latency']
+        self.assertEqual([(e['operation'], e['cost'], e['count'])
+                          for e in latency], [('check', 5, 3)])
+
+    def test_dummy_hash_is_cached_and_tracks_config(self):
+        with mock.patch.object(flask_bcrypt.bcrypt, 'hashpw',
+                               return_value=b'') as hashpw:
+            self.bcrypt.dummy_check('secret')
+            self.bcrypt.dummy_check('secret')
+            first, second = [c[0][1] for c in hashpw.call_args_list]
+            self.assertIs(first, second)
+            self.assertEqual(len(first), 60)
+            self.assertFalse(self.bcrypt.needs_rehash(first))
+
+            other = flask.Flask(__name__)
+            other.config['BCRYPT_LOG_ROUNDS'] = 4
+            self.bcrypt.init_app(other)
+            with other.app_context():
+                self.bcrypt.dummy_check('secret')
+                third = hashpw.call_args[0][1]
+                self.assertTrue(third.startswith(b'$2b$04$'))
+                self.assertFalse(self.bcrypt.needs_rehash(third))
+
+    def test_dummy_hash_is_valid(self):
+        PasswordHash(self.bcrypt._get_dummy_hash())
+        self.assertFalse(self.bcrypt.check_password_hash(
+            self.bcrypt._get_dummy_hash(), 'dummy password'))
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.bcrypt = Bcrypt(app)
+
+    def test_generate_and_check_ordered(self):
+        passwords = ['secret%d' % i for i in range(20)]
+        hashes = list(self.bcrypt.generate_password_hashes(passwords))
+        self.assertEqual(len(hashes), 20)
+        for pw_hash, password in zip(hashes, passwords):
+            self.assertTrue(pw_hash.startswith(b'$2b$04$'))
+            self.assertTrue(self.bcrypt.check_password_hash(pw_hash, password))
+        pairs = list(zip(hashes, passwords))
+        pairs[3] = (hashes[3], 'wrong')
+        results = list(self.bcrypt.check_password_hashes(pairs))
+        self.assertEqual(results, [i != 3 for i in range(20)])
+
+    def test_unordered(self):
+        passwords = ['secret%d' % i for i in range(10)]
+        results = dict(self.bcrypt.generate_password_hashes(
+            passwords, rounds=5, ordered=False))
+        self.assertEqual(sorted(results), list(range(10)))
+        pairs = [(results[i], passwords[i]) for i in range(10)]
+        checked = dict(self.bcrypt.check_password_hashes(pairs, ordered=False))
+        self.assertEqual(checked, dict.fromkeys(range(10), True))
+
+    def test_lazy_generator(self):
+        def passwords():
+            yield 'first'
+            raise AssertionError('consumed too eagerly')
+
+        hashes = self.bcrypt.generate_password_hashes(passwords())
+        with self.assertRaises(AssertionError):
+            next(hashes)
+
+    def test_empty_password(self):
+        with self.assertRaises(ValueError):
+            list(self.bcrypt.generate_password_hashes(['a', '']))
+
+
 if __name__ == '__main__':
     unittest.main()